@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the Visual Studio project generators, run on synthetic
+solutions of configurable size"""
+
+#
+# Copyright (c) 2011 Thomas Berg
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    from . import msvc
+except ImportError:
+    import msvc
+
+# Cycled through when naming the synthetic files, so each workload gets a
+# mix of ClCompile, ClInclude and None items
+file_extensions = ['.cpp', '.h', '.cpp', '.hpp', '.c', '.txt']
+
+def make_workload(num_projects, num_files, depth, variants, archs, version, toolset_version = None):
+    """Returns (projects, dependencies) for a synthetic solution with
+    num_projects projects of num_files files each. The files of a project
+    are spread over a folder tree depth levels deep, below the filters
+    'src' and 'include'. Each project depends on the one before it."""
+    ext = 'vcproj' if version <= 9.0 else 'vcxproj'
+    per_level = 4
+    project_info = {
+        'project_type' : 'Makefile',
+        'make_properties' : dict(
+            build_command_line="scons.bat",
+            clean_command_line="scons.bat -c",
+            rebuild_command_line="scons.bat -c && scons.bat",
+            output="foo.exe",
+            preprocessor_definitions="FOO;BAR",
+            include_search_path="C:/foo",
+            ),
+        'user_properties' : dict(
+            working_directory="C:/foo",
+            debugger_command="foo.exe",
+            ),
+    }
+    projects = []
+    for p in range(num_projects):
+        root = 'project%d' % p
+        files = {'src' : [], 'include' : [], '' : []}
+        for f in range(num_files):
+            folders = [root]
+            n = f
+            for level in range(depth):
+                folders.append('dir%d' % (n % per_level))
+                n //= per_level
+            extension = file_extensions[f % len(file_extensions)]
+            filepath = '/'.join(folders + ['file%d%s' % (f, extension)])
+            if extension == '.txt':
+                files[''].append(filepath)
+            elif extension.startswith('.h'):
+                files['include'].append(filepath)
+            else:
+                files['src'].append(filepath)
+        projects.append(msvc.Project(filepath = '%s/%s.%s' % (root, root, ext),
+                                     archs = archs,
+                                     variants = variants,
+                                     files = files,
+                                     project_info = project_info,
+                                     version = version,
+                                     toolset_version = toolset_version))
+    dependencies = {}
+    for previous, project in zip(projects, projects[1:]):
+        dependencies[project] = [previous]
+    return projects, dependencies
+
+class _NullWriter():
+    def write(self, s):
+        pass
+
+def _get_stages(version):
+    """Returns (name, setup, run) for each stage. setup(context) prepares
+    the input of the stage outside of the measurements and returns it,
+    run(context, data) is what gets measured."""
+    def write_trees(context, trees):
+        for i, xml in enumerate(trees):
+            msvc.write_xml(xml, os.path.join(context['outdir'], '%d.xml' % i), 'utf-8', True)
+
+    def solution(context, data):
+        msvc.write_solution(context['version'], context['projects'], context['variants'],
+                            context['archs'], context['dependencies'], _NullWriter())
+
+    def invalidate(context):
+        for p in context['projects']:
+            p.invalidate()
+
+    def generate_all(generator):
+        def run(context, data):
+            return [generator(p) for p in context['projects']]
+        return run
+
+    def generate_trees(context):
+        if version <= 9.0:
+            return [msvc.generate_xml_vc8(p) for p in context['projects']]
+        trees = []
+        for p in context['projects']:
+            trees.extend([msvc.generate_xml_vc10(p), msvc.generate_filters_vc10(p)])
+        return trees
+
+    stages = [
+        ('get_file_groups', lambda context: None,
+            lambda context, data: [msvc.get_file_groups(p.files) for p in context['projects']]),
+        ('file_model', invalidate,
+            lambda context, data: [p.get_file_model() for p in context['projects']]),
+    ]
+    if version <= 9.0:
+        stages.append(('generate_xml_vc8', lambda context: None, generate_all(msvc.generate_xml_vc8)))
+    else:
+        stages.extend([
+            ('generate_xml_vc10', lambda context: None, generate_all(msvc.generate_xml_vc10)),
+            ('render_vc10', lambda context: None, generate_all(msvc.render_vc10)),
+            ('generate_filters_vc10', lambda context: None, generate_all(msvc.generate_filters_vc10)),
+            ('generate_user_vc10', lambda context: None, generate_all(msvc.generate_user_vc10)),
+        ])
+    stages.extend([
+        ('write_xml', generate_trees, write_trees),
+        ('write_solution', lambda context: None, solution),
+    ])
+    return stages
+
+def _measure(context, setup, run):
+    """Returns (seconds, peak_bytes) for one stage. The time and the peak
+    memory are measured in separate runs, as tracing the allocations slows
+    down the code considerably."""
+    data = setup(context)
+    gc.collect()
+    start = time.perf_counter()
+    result = run(context, data)
+    seconds = time.perf_counter() - start
+    del result
+
+    data = setup(context)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = run(context, data)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+    return seconds, peak_bytes
+
+def measure_import_time(repeat = 20):
+    """Returns the shortest time in seconds it took a fresh interpreter to
+    import the msvc module, out of repeat runs. The bytecode is cached in a
+    temporary directory, so the compilation of the module is left out like
+    in a normal installation."""
+    directory = os.path.dirname(os.path.abspath(msvc.__file__))
+    code = ('import sys, time; sys.path.insert(0, %r); start = time.perf_counter(); '
+            'import msvc; print(time.perf_counter() - start)' % directory)
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    pycache = tempfile.mkdtemp(prefix = 'msvc_pycache')
+    times = []
+    try:
+        for i in range(repeat + 1):
+            output = subprocess.check_output([sys.executable, '-X', 'pycache_prefix=%s' % pycache, '-c', code], env = env)
+            times.append(float(output))
+    finally:
+        shutil.rmtree(pycache, ignore_errors = True)
+    # The first run compiled the module
+    return min(times[1:])
+
+def measure_project_memory(num_projects, num_files, depth, variants, archs, version, toolset_version = None):
+    """Returns the memory retained per Project of a workload in bytes, both
+    right after construction and with the file model and configuration
+    matrix computed"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        projects, dependencies = make_workload(num_projects, num_files, depth, variants, archs, version, toolset_version)
+        constructed = tracemalloc.get_traced_memory()[0]
+        for p in projects:
+            p.get_file_model()
+            p.configurations
+        with_model = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return constructed // num_projects, with_model // num_projects
+
+def run_benchmark(num_projects, num_files, depth, variants, archs, version, toolset_version = None):
+    """Runs all stages on one synthetic workload and returns the results"""
+    # Measured before building the workload of the stages: Project interns
+    # its paths, so those of a second workload would reuse its strings and
+    # not be counted
+    bytes_per_project, bytes_per_project_with_model = measure_project_memory(
+        num_projects, num_files, depth, variants, archs, version, toolset_version)
+    projects, dependencies = make_workload(num_projects, num_files, depth, variants, archs, version, toolset_version)
+    outdir = tempfile.mkdtemp(prefix = 'msvc_benchmark')
+    context = {
+        'projects' : projects,
+        'dependencies' : dependencies,
+        'variants' : variants,
+        'archs' : archs,
+        'version' : version,
+        'outdir' : outdir,
+    }
+    stages = {}
+    try:
+        for name, setup, run in _get_stages(version):
+            seconds, peak_bytes = _measure(context, setup, run)
+            stages[name] = {'seconds' : seconds, 'peak_bytes' : peak_bytes}
+    finally:
+        shutil.rmtree(outdir, ignore_errors = True)
+    return {
+        'workload' : {
+            'projects' : num_projects,
+            'files' : num_files,
+            'depth' : depth,
+            'variants' : variants,
+            'archs' : archs,
+            'version' : version,
+            'toolset_version' : toolset_version,
+        },
+        'stages' : stages,
+        'bytes_per_project' : bytes_per_project,
+        'bytes_per_project_with_model' : bytes_per_project_with_model,
+    }
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--projects', type = int, default = 100, help = 'number of projects')
+    parser.add_argument('--files', type = int, default = 1000, help = 'number of files per project')
+    parser.add_argument('--depth', type = int, default = 3, help = 'depth of the folder tree')
+    parser.add_argument('--variants', default = 'Debug,Release', help = 'comma separated variants')
+    parser.add_argument('--archs', default = 'Win32,x64', help = 'comma separated archs')
+    parser.add_argument('--versions', default = '9.0,15.0', help = 'comma separated Visual Studio versions')
+    parser.add_argument('--import-only', action = 'store_true', help = 'only measure the import time')
+    parser.add_argument('--output', default = 'benchmark.json', help = 'JSON file to write the results to')
+    args = parser.parse_args(argv)
+
+    results = {
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'import_seconds' : measure_import_time(),
+        'runs' : [],
+    }
+    print('import msvc: %.2f ms' % (results['import_seconds'] * 1e3))
+    versions = args.versions.split(',')
+    if args.import_only:
+        versions = []
+    for version in versions:
+        result = run_benchmark(args.projects, args.files, args.depth,
+                               args.variants.split(','), args.archs.split(','), float(version))
+        results['runs'].append(result)
+        print('Visual Studio %s' % version)
+        for name, _, _ in _get_stages(float(version)):
+            stage = result['stages'][name]
+            print('  %-24s %8.3f s %10.1f MB' % (name, stage['seconds'], stage['peak_bytes'] / 1e6))
+        print('  memory per project: %d bytes, %d bytes with the file model' % (
+            result['bytes_per_project'], result['bytes_per_project_with_model']))
+
+    with open(args.output, 'w') as out:
+        json.dump(results, out, indent = 1, sort_keys = True)
+    print('Wrote %s' % args.output)
+
+if __name__ == '__main__':
+    main()
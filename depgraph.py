@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Checks and simplifies the dependencies between the projects of a
+solution before they are written with msvc.write_solution:
+
+    dependencies = depgraph.reduce_dependencies(dependencies)
+
+leaves out the edges already implied by other dependencies, and raises
+DependencyCycleError if the projects depend on each other in a cycle."""
+
+#
+# Copyright (c) 2011 Thomas Berg
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+class DependencyCycleError(ValueError):
+    """Raised for dependencies that form a cycle. cycle lists the projects
+    on it, starting and ending with the same project."""
+
+    def __init__(self, cycle):
+        self.cycle = cycle
+        ValueError.__init__(self, 'Dependency cycle: %s' % ' -> '.join(p.name for p in cycle))
+
+class DependencyGraph(object):
+    """The dependencies between projects, with the projects indexed by
+    GUID, so distinct Project objects with the same GUID are the same
+    node. dependencies maps each project to the list of projects it
+    depends on; projects optionally adds projects without dependencies.
+
+    The nodes are numbered in topological order, dependencies first, which
+    fails with DependencyCycleError if there is a cycle."""
+
+    def __init__(self, dependencies, projects = None):
+        self.projects = []
+        self.index = {}
+        edges = []
+        def add(project):
+            i = self.index.get(project.guid)
+            if i is None:
+                i = self.index[project.guid] = len(self.projects)
+                self.projects.append(project)
+                edges.append([])
+            return i
+        for project in projects or []:
+            add(project)
+        for project, deps in dependencies.items():
+            i = add(project)
+            for dep in deps:
+                j = add(dep)
+                if j not in edges[i]:
+                    edges[i].append(j)
+        self.edges = edges
+        self.order = self._sort()
+        self.position = [0] * len(self.projects)
+        for n, i in enumerate(self.order):
+            self.position[i] = n
+
+    def _sort(self):
+        """Returns the nodes in topological order, with an iterative depth
+        first search so deep graphs do not hit the recursion limit"""
+        new, active, done = 0, 1, 2
+        state = [new] * len(self.projects)
+        order = []
+        for root in range(len(self.projects)):
+            if state[root] != new:
+                continue
+            state[root] = active
+            stack = [(root, iter(self.edges[root]))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if state[child] == new:
+                        state[child] = active
+                        stack.append((child, iter(self.edges[child])))
+                        break
+                    if state[child] == active:
+                        path = [n for n, _ in stack]
+                        cycle = path[path.index(child):] + [child]
+                        raise DependencyCycleError([self.projects[n] for n in cycle])
+                else:
+                    stack.pop()
+                    state[node] = done
+                    order.append(node)
+        return order
+
+    def get_reduced_edges(self):
+        """Returns the edges of the transitive reduction: for each node, the
+        dependencies not reachable through another of its dependencies, in
+        their original order.
+
+        The nodes are visited in topological order, keeping the set of
+        nodes each one reaches as a bitset indexed by topological position.
+        A dependency is redundant if a dependency closer to the node
+        already reaches it, which takes one bit test per edge and one bitset
+        union per kept edge."""
+        reach = [0] * len(self.projects)
+        position = self.position
+        reduced = [None] * len(self.projects)
+        for node in self.order:
+            reached = 0
+            kept = set()
+            # The dependency latest in the order is the only one that can
+            # reach the others, so it is looked at first
+            for dep in sorted(self.edges[node], key = lambda n: -position[n]):
+                if not (reached >> position[dep]) & 1:
+                    kept.add(dep)
+                    reached |= reach[dep] | (1 << position[dep])
+            reach[node] = reached
+            reduced[node] = [dep for dep in self.edges[node] if dep in kept]
+        return reduced
+
+    def get_topological_order(self):
+        """Returns the projects in an order where each project comes after
+        all the projects it depends on"""
+        return [self.projects[i] for i in self.order]
+
+def reduce_dependencies(dependencies, projects = None):
+    """Returns the transitive reduction of dependencies, as a dict in the
+    form write_solution takes: only the dependencies not implied by other
+    dependencies are kept, which leaves the build order unchanged. Raises
+    DependencyCycleError if there is a cycle."""
+    graph = DependencyGraph(dependencies, projects)
+    reduced = graph.get_reduced_edges()
+    result = {}
+    for project in dependencies:
+        deps = reduced[graph.index[project.guid]]
+        if deps:
+            result[project] = [graph.projects[dep] for dep in deps]
+    return result
+
+#====== Code for testing ======
+class _TestProject(object):
+    def __init__(self, name, guid = None):
+        self.name = name
+        self.guid = guid or '{%s}' % name
+
+def test():
+    """Checks the transitive reduction and the cycle detection"""
+    a, b, c, d = [_TestProject(name) for name in 'abcd']
+    # A diamond, plus the redundant edges a -> d and a -> c -> d
+    dependencies = {a : [d, b, c], b : [d], c : [d]}
+    reduced = reduce_dependencies(dependencies)
+    assert reduced == {a : [b, c], b : [d], c : [d]}, reduced
+    order = DependencyGraph(dependencies).get_topological_order()
+    assert order.index(d) < order.index(b) < order.index(a) and order.index(c) < order.index(a), order
+    # A chain with a shortcut, and another object for the same project
+    reduced = reduce_dependencies({a : [b, c], b : [_TestProject('c2', c.guid)]}, [d])
+    assert reduced == {a : [b], b : [c]}, reduced
+
+    for dependencies, members in [({a : [a]}, [a]),
+                                  ({a : [b], b : [c], c : [a], d : [a]}, [a, b, c])]:
+        try:
+            DependencyGraph(dependencies)
+        except DependencyCycleError as e:
+            assert e.cycle[0] is e.cycle[-1] and len(e.cycle) == len(members) + 1, e.cycle
+            assert sorted(p.name for p in e.cycle[1:]) == [p.name for p in members], e.cycle
+        else:
+            assert False, 'No DependencyCycleError for %r' % dependencies
+    print('Checked the dependency graph')
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Reads solutions and vc10 projects written by msvc back into Project
+objects, so they can be edited and written again"""
+
+#
+# Copyright (c) 2011 Thomas Berg
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import ntpath
+import os
+import re
+
+try:
+    from . import msvc
+except ImportError:
+    import msvc
+
+solution_items_guid = '{2150E333-8FDC-42A3-9474-1A3956D46DE8}'
+
+_project_line = re.compile(r'^Project\("([^"]*)"\) = "([^"]*)", "([^"]*)", "([^"]*)"')
+_dependency_line = re.compile(r'^\s*(\{[^}]*\})\s*=\s*(\{[^}]*\})\s*$')
+_configuration_line = re.compile(r'^\s*([^|=]+)\|([^=]+?)\s*=')
+_condition = re.compile(r"^\s*'\$\(Configuration\)\|\$\(Platform\)'=='([^|]*)\|([^']*)'\s*$")
+_or = re.compile(r'\s+Or\s+', re.IGNORECASE)
+_toolset = re.compile(r'^v(\d+)$')
+
+class Solution(object):
+    """A solution read by read_solution. The attributes match the arguments
+    of msvc.write_solution: version, projects, variants, archs,
+    dependencies, solution_items and folders. warnings lists the files whose filter
+    could not be expressed in the file map of their project, and which
+    will be put in a different filter when written again."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.version = None
+        self.projects = []
+        self.variants = []
+        self.archs = []
+        self.dependencies = {}
+        self.solution_items = []
+        self.folders = {}
+        self.warnings = []
+
+    def get_project(self, name):
+        for project in self.projects:
+            if project.name == name:
+                return project
+        raise KeyError(name)
+
+def _local_name(tag):
+    return tag.rpartition('}')[2]
+
+def _append_unique(items, item):
+    if item not in items:
+        items.append(item)
+
+def _read_version(first_lines):
+    for version in sorted(msvc.sln_headers):
+        if msvc.sln_headers[version] == first_lines:
+            return version
+    raise ValueError('Unknown solution file format: %r' % first_lines)
+
+def _iter_elements(filepath):
+    """Yields the elements of an XML file as they are completed, with
+    namespaces removed from the tags. The elements are cleared once the
+    caller has processed them, so only the current path of the tree is
+    kept in memory. Returns nothing if the file does not exist."""
+    if not os.path.exists(filepath):
+        return
+    for event, elem in msvc.ET.iterparse(filepath, events = ('end',)):
+        yield _local_name(elem.tag), elem
+        if _local_name(elem.tag) in ('PropertyGroup', 'ItemGroup', 'ImportGroup'):
+            elem.clear()
+
+def _parse_condition(condition):
+    """Returns the (variant, arch) pairs a PropertyGroup condition selects,
+    None for no condition, or an empty list if it cannot be parsed"""
+    if condition is None:
+        return None
+    configurations = []
+    for part in _or.split(condition):
+        match = _condition.match(part)
+        if match is None:
+            return []
+        configurations.append(match.groups())
+    return configurations
+
+def _read_property_groups(filepath, property_map):
+    """Returns ({(variant, arch) : dict}, collapsed) for the PropertyGroups
+    of a project or user file, mapping the property names with
+    property_map. Groups without a condition are returned with the key
+    None. collapsed tells if any group applies to several configurations,
+    as written with collapse_properties."""
+    reverse_map = dict((v, k) for k, v in property_map.items())
+    result = {}
+    collapsed = False
+    for tag, elem in _iter_elements(filepath):
+        if tag != 'PropertyGroup' or elem.get('Label') is not None:
+            continue
+        d = {}
+        for child in elem:
+            key = reverse_map.get(_local_name(child.tag))
+            if key is not None:
+                d[key] = child.text or ''
+        if not d:
+            continue
+        configurations = _parse_condition(elem.get('Condition'))
+        if configurations is None:
+            result[None] = d
+        if configurations is None or len(configurations) > 1:
+            collapsed = True
+        for configuration in configurations or []:
+            result[configuration] = d
+    return result, collapsed
+
+def _add_properties(project_info, entry, groups):
+    for configuration, d in groups.items():
+        if configuration is None:
+            project_info[entry] = d
+        else:
+            project_info['%s|%s|%s' % ((entry,) + configuration)] = d
+
+def _split_filter(filter, path):
+    """Splits the filter of a file into the filter it must be listed under
+    in the file map, given its path, or returns None if that is impossible"""
+    folders = [c for c in ntpath.split(path)[0].split('\\') if c]
+    components = [c for c in filter.split('\\') if c]
+    if not folders:
+        return '\\'.join(components)
+    if len(components) < len(folders) or components[len(components) - len(folders):] != folders:
+        return None
+    return '\\'.join(components[:len(components) - len(folders)])
+
+def read_project(filepath, project_path = None, version = None, guid = None, name = None, warnings = None):
+    """Reads a vc10 project file, with its .filters and .user files if they
+    exist, into an msvc.Project.
+
+    project_path is the path of the project relative to the solution, as
+    listed in it, and defaults to filepath. The paths in the file map of the
+    project are relative to the directory of the solution. If warnings is a
+    list, the files whose filter cannot be expressed by the file map are
+    appended to it."""
+    if project_path is None:
+        project_path = filepath
+    project_path = project_path.replace('\\', '/')
+    project_dir = ntpath.split(project_path)[0]
+
+    configurations = []
+    toolsets = []
+    items = []
+    for tag, elem in _iter_elements(filepath):
+        if tag == 'ProjectConfiguration':
+            configurations.append(tuple(elem.get('Include').split('|', 1)))
+        elif tag == 'PlatformToolset' and elem.text:
+            _append_unique(toolsets, elem.text)
+        elif tag in msvc.item_groups and elem.get('Include') is not None:
+            items.append(elem.get('Include'))
+
+    filters = {}
+    for tag, elem in _iter_elements(filepath + '.filters'):
+        if tag in msvc.item_groups and elem.get('Include') is not None:
+            for child in elem:
+                if _local_name(child.tag) == 'Filter':
+                    filters[elem.get('Include')] = child.text or ''
+
+    project_info = {'project_type' : 'Makefile'}
+    make_groups, make_collapsed = _read_property_groups(filepath, msvc.properties_map_vc10)
+    user_groups, user_collapsed = _read_property_groups(filepath + '.user', msvc.user_map_vc10)
+    _add_properties(project_info, 'make_properties', make_groups)
+    _add_properties(project_info, 'user_properties', user_groups)
+
+    files = {}
+    for include in items:
+        path = ntpath.normpath(ntpath.join(project_dir, include))
+        filter = filters.get(include, '')
+        type_filter = _split_filter(filter, path)
+        if type_filter is None:
+            type_filter = filter
+            if warnings is not None:
+                warnings.append(path)
+        files.setdefault(type_filter, []).append(path.replace('\\', '/'))
+
+    archs = []
+    variants = []
+    for variant, arch in configurations:
+        _append_unique(variants, variant)
+        _append_unique(archs, arch)
+
+    toolset_version = None
+    if toolsets:
+        match = _toolset.match(toolsets[0])
+        if match is None:
+            # Such as v141_xp or ClangCL, kept by name
+            toolset_version = toolsets[0]
+        elif version is None or toolsets[0] != 'v%s' % int(version * 10):
+            toolset_version = int(match.group(1)) / 10.0
+
+    return msvc.Project(filepath = project_path,
+                        archs = archs,
+                        variants = variants,
+                        files = files,
+                        project_info = project_info,
+                        name = name,
+                        version = version,
+                        toolset_version = toolset_version,
+                        guid = guid,
+                        collapse_properties = make_collapsed or user_collapsed)
+
+def read_solution(filepath):
+    """Reads a solution file and its vc10 projects, streaming through the
+    files so memory use is bounded by the size of the resulting model.
+    Returns a Solution."""
+    solution = Solution(filepath)
+    root = os.path.split(filepath)[0]
+    entries = []
+    dependencies = {}
+    folder_names = {}
+    nested = {}
+    section = None
+    current = None
+    with open(filepath) as f:
+        header = f.readline() + f.readline()
+        solution.version = _read_version(header)
+        for line in f:
+            stripped = line.strip()
+            match = _project_line.match(line)
+            if match:
+                type_guid, name, path, guid = match.groups()
+                current = guid
+                if type_guid == solution_items_guid:
+                    current = None
+                    folder_names[guid] = name
+                else:
+                    entries.append((name, path, guid))
+            elif stripped.startswith('ProjectSection(ProjectDependencies)'):
+                section = 'dependencies'
+            elif stripped.startswith('ProjectSection(SolutionItems)'):
+                section = 'items'
+            elif stripped.startswith('GlobalSection(NestedProjects)'):
+                section = 'nested'
+            elif stripped.startswith('GlobalSection(SolutionConfigurationPlatforms)'):
+                section = 'configurations'
+            elif stripped.startswith('EndProjectSection') or stripped.startswith('EndGlobalSection'):
+                section = None
+            elif section == 'dependencies':
+                match = _dependency_line.match(line)
+                if match:
+                    dependencies.setdefault(current, []).append(match.group(1))
+            elif section == 'items' and stripped:
+                solution.solution_items.append(stripped)
+            elif section == 'nested':
+                match = _dependency_line.match(line)
+                if match:
+                    nested[match.group(1)] = match.group(2)
+            elif section == 'configurations':
+                match = _configuration_line.match(line)
+                if match:
+                    _append_unique(solution.variants, match.group(1).strip())
+                    _append_unique(solution.archs, match.group(2).strip())
+
+    by_guid = {}
+    for name, path, guid in entries:
+        project_file = os.path.join(root, *path.split('\\'))
+        if path.endswith('.vcproj'):
+            raise ValueError('Reading vc8 projects is not supported: %s' % path)
+        project = read_project(project_file, project_path = path, version = solution.version,
+                               guid = guid, name = name, warnings = solution.warnings)
+        solution.projects.append(project)
+        by_guid[guid] = project
+
+    for guid, deps in dependencies.items():
+        solution.dependencies[by_guid[guid]] = [by_guid[d] for d in deps if d in by_guid]
+    for guid, project in by_guid.items():
+        path = []
+        parent = nested.get(guid)
+        while parent in folder_names and len(path) < len(folder_names):
+            path.insert(0, folder_names[parent])
+            parent = nested.get(parent)
+        if path:
+            solution.folders[project] = '/'.join(path)
+    return solution
+
+#====== Code for testing ======
+def _read_tree(root):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, root)] = f.read()
+    return files
+
+def test():
+    """Checks that writing a solution, reading it back and writing it again
+    gives the same files"""
+    import copy
+    import shutil
+    import tempfile
+    projects, dependencies = msvc._get_test_projects(['Debug', 'Release'], ['Win32', 'x64'], 15.0, None)
+    user_properties = {'working_directory' : 'C:/foo', 'debugger_command' : 'foo.exe'}
+    for project in projects:
+        project.project_info = dict(project.project_info, user_properties = user_properties)
+        project.invalidate()
+    # Collapsed, with the x64 configurations differing from the others
+    projects[0].project_info = copy.deepcopy(projects[0].project_info)
+    projects[0].project_info['make_properties|x64']['output'] = 'foo64.exe'
+    projects[0].collapse_properties = True
+    projects[1].toolset_version = 'ClangCL'
+    testroot = tempfile.mkdtemp(prefix = 'importer_test')
+    try:
+        first = os.path.join(testroot, 'first', 'test.sln')
+        results = msvc.write_all(first, projects, dependencies, jobs = 1, solution_items = ['SConstruct'],
+                                 folders = {projects[0] : 'libraries/core'})
+        assert [error for path, error in results] == [None] * len(results), results
+        solution = read_solution(first)
+        assert solution.warnings == [], solution.warnings
+        second = os.path.join(testroot, 'second', 'test.sln')
+        msvc.write_all(second, solution.projects, solution.dependencies, jobs = 1,
+                       version = solution.version, variants = solution.variants, archs = solution.archs,
+                       solution_items = solution.solution_items, folders = solution.folders)
+        expected = _read_tree(os.path.dirname(first))
+        actual = _read_tree(os.path.dirname(second))
+        assert sorted(actual) == sorted(expected), (sorted(actual), sorted(expected))
+        for name in expected:
+            assert actual[name] == expected[name], 'Round trip changed %s' % name
+    finally:
+        shutil.rmtree(testroot, ignore_errors = True)
+    print('Checked the round trip through the importer')
+
+if __name__ == '__main__':
+    test()
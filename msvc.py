@@ -27,17 +27,44 @@
 #
 
 import codecs
-import hashlib
 import ntpath
 import os
 import sys
+import time
+
+# The module is imported by SCons on every build, so anything that is not
+# needed to define the projects is imported on first use: hashlib, json
+# and multiprocessing in the functions using them, and ElementTree through
+# the stand-in below.
+
+def _import_element_tree():
+    global ET
+    if sys.version_info >= (3, 3):
+        # Uses the C implementation when available. cElementTree is
+        # deprecated since 3.3 and was removed in 3.9.
+        import xml.etree.ElementTree as module
+    else:
+        try:
+            import xml.etree.cElementTree as module
+        except ImportError:
+            import xml.etree.ElementTree as module
+    ET = module
+    return module
+
+class _LazyElementTree(object):
+    """Stands in for the ElementTree module until it is first used, then
+    replaces itself with the module."""
+    def __getattr__(self, name):
+        return getattr(_import_element_tree(), name)
 
-import xml.etree.cElementTree as ET
-from xml.dom import minidom
+ET = _LazyElementTree()
 
 # From SCons
 external_makefile_guid = '{8BC9CEB8-8B4A-11D0-8D11-00A0C91BC942}'
 
+# The project type of solution folders, including Solution Items
+solution_folder_guid = '{2150E333-8FDC-42A3-9474-1A3956D46DE8}'
+
 # Version numbers and cl.exe version numbers:
 # Visual Studio 2005  8.0 14.00
 # Visual Studio 2008  9.0 15.00
@@ -73,9 +100,19 @@ tools_map_vc8 = {
     'make_properties' : 'VCNMakeTool',
 }
 
-tools_reverse_map_vc8 = {}
-for k in tools_map_vc8.keys():
-    tools_reverse_map_vc8[tools_map_vc8[k]] = k
+_tools_reverse_map_vc8 = None
+
+def _get_tools_reverse_map_vc8():
+    global _tools_reverse_map_vc8
+    if _tools_reverse_map_vc8 is None:
+        _tools_reverse_map_vc8 = dict((v, k) for k, v in tools_map_vc8.items())
+    return _tools_reverse_map_vc8
+
+def __getattr__(name):
+    # Keeps tools_reverse_map_vc8 available, built on first access
+    if name == 'tools_reverse_map_vc8':
+        return _get_tools_reverse_map_vc8()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 properties_map_vc8 = {
     'build_command_line'         : 'BuildCommandLine',
@@ -95,6 +132,12 @@ properties_map_vc10 = {
     'include_search_path'        : 'NMakeIncludeSearchPath',
 }
 
+# Item types used for files in vc10 projects, in the order they are written
+item_groups = ['None', 'ClCompile', 'ClInclude']
+
+header_extensions = set(['.h', '.hpp', '.hxx', 'txx'])
+cl_extensions = set(['.c', '.cpp', '.cxx'])
+
 user_map_vc10 = {
     'working_directory'          : 'LocalDebuggerWorkingDirectory',
     'debugger_flavor'            : 'DebuggerFlavor',
@@ -170,10 +213,24 @@ configuration_tools_vc8 = {
     ],
 }
 
+def _unique(items):
+    seen = set()
+    result = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
 def get_toolset_version(project):
+    """Returns the PlatformToolset of a project. toolset_version may also
+    be the name of a toolset, such as 'v141_xp' or 'ClangCL', which is
+    used as it is."""
     version = project.toolset_version
     if version is None:
         version = project.version
+    if not isinstance(version, (int, float)):
+        return version
     return 'v%s' % int(version * 10)
 
 # From SCons
@@ -184,11 +241,12 @@ def xmlify(s):
     return s
 
 # From SCons
-def _generateGUID(slnfile, name):
+def _hashGUID(slnfile, name):
     """This generates a dummy GUID for the sln file to use.  It is
     based on the MD5 signatures of the sln filename plus the name of
     the project.  It basically just needs to be unique, and not
     change with each invocation."""
+    import hashlib
     m = hashlib.md5()
     # Normalize the slnfile path to a Windows path (\ separators) so
     # the generated file has a consistent GUID even if we generate
@@ -199,11 +257,196 @@ def _generateGUID(slnfile, name):
     solution = "{" + solution[:8] + "-" + solution[8:12] + "-" + solution[12:16] + "-" + solution[16:20] + "-" + solution[20:32] + "}"
     return solution
 
-class Project():
-    def __init__(self, filepath, archs, variants, files, project_info, name = None, src_root = None, strip_path = None, version = None, toolset_version = None):
+class GuidRegistry():
+    """Hands out the GUIDs for projects and filters, keyed by (file, name).
+
+    GUIDs are memoized, so each one is hashed only once per process. If a
+    store file is given, the GUIDs recorded in it are reused instead of
+    being hashed again, and save() writes all GUIDs handed out back to it.
+    GUIDs can also be pinned to a (file, name) key, which takes precedence
+    over hashing, for instance to keep the GUID of an existing project.
+    Projects look up their GUID under their file path and name, but hash
+    it with the name given to Project, None if defaulted, so GUIDs saved
+    for such projects are stored under that key."""
+
+    def __init__(self, store = None):
+        self.store = store
+        self.guids = {}
+        self.stored = {}
+        self._stored_by_file = None
+        if store is not None and os.path.exists(store):
+            import json
+            with open(store) as f:
+                self.stored = json.load(f).get('guids', {})
+
+    @staticmethod
+    def _key(slnfile, name):
+        return '%s|%s' % (ntpath.normpath(str(slnfile)), name)
+
+    def find(self, slnfile, name):
+        """Returns the GUID stored or pinned for (file, name), or None"""
+        return self.stored.get(self._key(slnfile, name))
+
+    def get(self, slnfile, name):
+        try:
+            return self.guids[(slnfile, name)]
+        except KeyError:
+            pass
+        guid = self.stored.get(self._key(slnfile, name))
+        if guid is None:
+            guid = _hashGUID(slnfile, name)
+        self.guids[(slnfile, name)] = guid
+        return guid
+
+    def pin(self, slnfile, name, guid):
+        self.stored[self._key(slnfile, name)] = guid
+        self.guids.pop((slnfile, name), None)
+        self._stored_by_file = None
+
+    def get_stored(self, slnfile):
+        """Returns the sorted (key, guid) pairs stored or pinned for a file,
+        which take precedence over the hashed GUIDs"""
+        if self._stored_by_file is None:
+            by_file = {}
+            for key in sorted(self.stored):
+                by_file.setdefault(key.partition('|')[0], []).append((key, self.stored[key]))
+            self._stored_by_file = by_file
+        return self._stored_by_file.get(ntpath.normpath(str(slnfile)), [])
+
+    def save(self, store = None):
+        import json
+        if store is None:
+            store = self.store
+        guids = dict(self.stored)
+        for (slnfile, name), guid in self.guids.items():
+            guids[self._key(slnfile, name)] = guid
+        _prepare_dirs(store)
+        _atomic_write(store, json.dumps({'guids' : guids}, indent = 1, sort_keys = True).encode('utf-8'))
+
+# Used for all generated GUIDs. Replace it with a GuidRegistry having a
+# store to persist and pin GUIDs across runs.
+guid_registry = GuidRegistry()
+
+def _generateGUID(slnfile, name):
+    return guid_registry.get(slnfile, name)
+
+class ConfigurationMatrix():
+    """The entries of a project_info dict resolved for every configuration.
+
+    An entry such as 'make_properties' is looked up with these keys, from
+    the most to the least specific:
+
+        'entry|variant|arch'
+        'entry|variant'  or 'entry|variant|*'
+        'entry|arch'     or 'entry|*|arch'
+        'entry'          or 'entry|*' or 'entry|*|*'
+
+    By default the most specific dict found is used as is. With merge set,
+    the dicts found on all levels are merged instead, so the more specific
+    ones only need to contain the values they override. All entries are
+    resolved for the variants and archs up front, so get() is a single
+    dictionary lookup."""
+
+    def __init__(self, project_info, variants, archs, merge = False):
+        self.project_info = project_info
+        self.merge = merge
+        self.entries = _unique(key.split('|')[0] for key in project_info
+                               if isinstance(project_info[key], dict))
+        self.matrix = {}
+        for entry in self.entries:
+            for variant in variants:
+                for arch in archs:
+                    self.matrix[(entry, variant, arch)] = self._resolve(entry, variant, arch)
+
+    def _lookup(self, *keys):
+        for key in keys:
+            d = self.project_info.get(key)
+            if d is not None:
+                return d
+        return None
+
+    def _resolve(self, entry, variant, arch):
+        levels = [
+            self._lookup('%s|%s|%s' % (entry, variant, arch)),
+            self._lookup('%s|%s' % (entry, variant), '%s|%s|*' % (entry, variant)),
+            self._lookup('%s|%s' % (entry, arch), '%s|*|%s' % (entry, arch)),
+            self._lookup(entry, '%s|*' % entry, '%s|*|*' % entry),
+        ]
+        if not self.merge:
+            for d in levels:
+                if d is not None:
+                    return d
+            return None
+        result = None
+        for d in reversed(levels):
+            if d is not None:
+                if result is None:
+                    result = dict(d)
+                else:
+                    result.update(d)
+        return result
+
+    def get(self, entry, variant, arch):
+        try:
+            d = self.matrix[(entry, variant, arch)]
+        except KeyError:
+            d = self.matrix[(entry, variant, arch)] = self._resolve(entry, variant, arch)
+        if d is None:
+            return dict()
+        return d
+
+_intern = getattr(sys, 'intern', None) or intern
+
+def _intern_path(s):
+    if type(s) is str:
+        return _intern(s)
+    return s
+
+def _compact_files(files):
+    """Returns a copy of a file map with tuples of interned paths, so paths
+    shared between projects are only stored once"""
+    result = {}
+    for key in files:
+        result[_intern_path(key)] = tuple(_intern_path(f) for f in files[key])
+    return result
+
+class Project(object):
+    """A project in a solution. Uses slots and keeps the file map as tuples
+    of interned strings to stay small, since a solution can hold many
+    thousands of projects. The data derived from the project (the file
+    model, the configuration matrix and the configuration list) is computed
+    on first use and cached. Assigning files discards it automatically;
+    call invalidate() after changing anything else.
+
+    With collapse_properties set, configurations with identical make or
+    user properties share one PropertyGroup in the vc10 files, which is
+    unconditional if all configurations share it."""
+
+    __slots__ = [
+        'filepath',
+        'archs',
+        'variants',
+        'project_info',
+        'configuration_type',
+        '_files',
+        'name',
+        'src_root',
+        'strip_path',
+        'version',
+        'toolset_version',
+        'guid',
+        'merge_project_info',
+        'collapse_properties',
+        '_file_model',
+        '_configurations',
+        '_configuration_list',
+    ]
+    _cached_slots = ['_file_model', '_configurations', '_configuration_list']
+
+    def __init__(self, filepath, archs, variants, files, project_info, name = None, src_root = None, strip_path = None, version = None, toolset_version = None, guid = None, merge_project_info = False, collapse_properties = False):
         self.filepath = filepath
-        self.archs = archs
-        self.variants = variants
+        self.archs = tuple(archs)
+        self.variants = tuple(variants)
         self.project_info = project_info
         self.configuration_type = project_info['project_type']
         self.files = files
@@ -212,24 +455,86 @@ class Project():
         self.strip_path = strip_path
         self.version = version
         self.toolset_version = toolset_version
+        self.merge_project_info = merge_project_info
+        self.collapse_properties = collapse_properties
         if name is None:
             self.name = os.path.splitext(os.path.split(filepath)[-1])[0]
 
-        self.guid = _generateGUID(filepath, name)
+        # An explicit guid keeps the project's identity if its path changes
+        if guid is None:
+            guid = guid_registry.find(filepath, self.name)
+        if guid is None:
+            # Hashed with the name as given, None if defaulted, which keeps
+            # the GUIDs of existing projects
+            guid = _generateGUID(filepath, name)
+        self.guid = guid
+
+    def __getstate__(self):
+        # The cached data is left out to keep pickles (as sent to the
+        # write_all workers) small
+        return dict((key, getattr(self, key)) for key in self.__slots__
+                    if key not in self._cached_slots)
+
+    def __setstate__(self, state):
+        for key in state:
+            setattr(self, key, state[key])
+        self.invalidate()
+
+    @property
+    def files(self):
+        return self._files
+
+    @files.setter
+    def files(self, files):
+        self._files = _compact_files(files)
+        self.invalidate()
+
+    @property
+    def configurations(self):
+        """The ConfigurationMatrix for the project_info of the project"""
+        if self._configurations is None:
+            self._configurations = ConfigurationMatrix(self.project_info, self.variants, self.archs, self.merge_project_info)
+        return self._configurations
+
+    def get_configurations(self):
+        """Returns the (variant, arch) pairs of the project, in the order
+        the project files list them"""
+        if self._configuration_list is None:
+            self._configuration_list = tuple((variant, arch) for arch in self.archs for variant in self.variants)
+        return self._configuration_list
+
+    def get_file_model(self):
+        """Returns the FileModel of the project, computing it on first use"""
+        if self._file_model is None:
+            self._file_model = FileModel(self)
+        return self._file_model
+
+    def invalidate(self):
+        """Discards the data computed from the files, paths, configurations
+        and project_info"""
+        for key in self._cached_slots:
+            setattr(self, key, None)
 
     def get_project_info(self, entry, variant, arch):
-        possible_keys = [
-            '%s|%s|%s' % (entry, variant, arch),
-            '%s|%s' % (entry, variant),
-            '%s|%s' % (entry, arch),
-            entry,
-            ]
-        for key in possible_keys:
-            try:
-                return self.project_info[key]
-            except KeyError:
-                pass
-        return dict()
+        return self.configurations.get(entry, variant, arch)
+
+    def for_version(self, version, toolset_version = None, filepath = None):
+        """Returns a copy of the project for another Visual Studio version,
+        optionally at another path. The copy shares the file map and the
+        project_info, and the data derived from them that this project has
+        computed so far: call get_file_model() first to compute the file
+        model only once for all versions. The file model is only shared if
+        the copy is in the same directory."""
+        project = Project.__new__(Project)
+        for key in self.__slots__:
+            setattr(project, key, getattr(self, key))
+        project.version = version
+        project.toolset_version = toolset_version
+        if filepath is not None:
+            project.filepath = filepath
+            if ntpath.split(filepath.replace('/', '\\'))[0] != ntpath.split(self.filepath.replace('/', '\\'))[0]:
+                project._file_model = None
+        return project
 
 def _strip_folder(subfolder, strip_path):
     if strip_path is None:
@@ -239,63 +544,176 @@ def _strip_folder(subfolder, strip_path):
     result = subfolder[len(strip_path)+1:]
     return result
 
+def _get_filter(type_filter, filepath, strip_path):
+    """Returns the filter of a file, made up of the filter it is listed
+    under in the project's file map followed by its folder."""
+    subfolder = _strip_folder(os.path.split(filepath)[0], strip_path)
+    total_filter = type_filter
+    if subfolder:
+        if total_filter:
+            total_filter += '/'
+        total_filter += subfolder
+    return total_filter.replace('/', '\\')
+
+def _get_file_group(filepath):
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext in cl_extensions:
+        return 'ClCompile'
+    elif ext in header_extensions:
+        return 'ClInclude'
+    return 'None'
+
+class _RelativePaths():
+    """Makes Windows paths (backslash separated) relative to the directory
+    start, like ntpath.relpath but independent of the platform we generate
+    on. The start directory is split once, and the relative prefix of each
+    source directory is computed only once, so many files in the same
+    folder cost a lookup each. Files on another drive than start keep
+    their absolute path."""
+
+    def __init__(self, start):
+        drive, path = ntpath.splitdrive(ntpath.abspath(start or '.'))
+        self.drive = drive.lower()
+        self.start = [c.lower() for c in path.split('\\') if c]
+        self.prefixes = {}
+
+    def _get_prefix(self, directory):
+        absolute = ntpath.abspath(directory or '.')
+        drive, path = ntpath.splitdrive(absolute)
+        if drive.lower() != self.drive:
+            return absolute.rstrip('\\') + '\\'
+        parts = [c for c in path.split('\\') if c]
+        common = 0
+        for a, b in zip(self.start, parts):
+            if a != b.lower():
+                break
+            common += 1
+        relative = ['..'] * (len(self.start) - common) + parts[common:]
+        return ''.join(c + '\\' for c in relative)
+
+    def relpath(self, filepath):
+        i = filepath.rfind('\\') + 1
+        directory = filepath[:i]
+        try:
+            prefix = self.prefixes[directory]
+        except KeyError:
+            prefix = self.prefixes[directory] = self._get_prefix(directory)
+        return prefix + filepath[i:]
+
+class FileEntry(object):
+    __slots__ = ['path', 'relative', 'group', 'filter']
+
+    def __init__(self, path, relative, group, filter):
+        self.path = path
+        self.relative = relative
+        self.group = group
+        self.filter = filter
+
+    def __repr__(self):
+        return 'FileEntry(%r, %r, %r, %r)' % (self.path, self.relative, self.group, self.filter)
+
+class FilterNode(object):
+    """A filter in the filter tree of a FileModel. path is the full filter,
+    shared by the FileEntry objects in it. items holds the child filters
+    and the files directly in the filter, in the order they were first
+    met, which is the order of the vc8 Filter and File elements."""
+
+    __slots__ = ['name', 'path', 'items']
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.items = []
+
+    def get_children(self):
+        return [item for item in self.items if type(item) is FilterNode]
+
+    def iter_filters(self):
+        """Yields the filters below this one in preorder, with the children
+        of each filter sorted by name"""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node is not self:
+                yield node
+            stack.extend(sorted(node.get_children(), key = lambda child: child.name, reverse = True))
+
+    def __repr__(self):
+        return 'FilterNode(%r)' % self.path
+
+class FileModel():
+    """The files of a project as needed by the generators, computed in one
+    pass over the project's file map:
+
+    files   -- a FileEntry for each file, in file map order
+    groups  -- (item group, list of FileEntry) pairs, ordered as item_groups
+    root    -- the FilterNode at the root of the filter tree
+    filters -- all filters including the parent filters, in the preorder
+               of the filter tree with sorted siblings
+
+    Each FileEntry holds the Windows path of the file (including src_root),
+    the path relative to the project file, the vc10 item group and the
+    filter, using backslash separators."""
+
+    def __init__(self, project):
+        src_root = project.src_root
+        strip_path = project.strip_path
+        relative_paths = _RelativePaths(ntpath.split(project.filepath)[0])
+
+        self.files = []
+        self.root = FilterNode('', '')
+        grouped = dict((g, []) for g in item_groups)
+        # The filter nodes by filter, also as written in the file map. Each
+        # distinct filter is split into its components only once.
+        nodes = {'' : self.root}
+        for type_filter in project.files:
+            for filepath in project.files[type_filter]:
+                total_filter = _get_filter(type_filter, filepath, strip_path)
+                node = nodes.get(total_filter)
+                if node is None:
+                    # Walks up to the closest filter already in the tree,
+                    # then adds the missing ones below it: adding
+                    # 'foo\bar\chi' also adds 'foo' and 'foo\bar'
+                    missing = []
+                    prefix = total_filter
+                    while node is None:
+                        missing.append(prefix)
+                        prefix = prefix.rpartition('\\')[0]
+                        node = nodes.get(prefix)
+                    for prefix in reversed(missing):
+                        name = prefix.rpartition('\\')[2]
+                        if name:
+                            path = node.path + '\\' + name if node.path else name
+                            child = nodes.get(path)
+                            if child is None:
+                                child = nodes[path] = FilterNode(name, path)
+                                node.items.append(child)
+                            node = child
+                        nodes[prefix] = node
+                group = _get_file_group(filepath)
+                if src_root is not None:
+                    filepath = os.path.join(src_root, filepath)
+                filepath = filepath.replace('/', '\\')
+                relative = relative_paths.relpath(filepath)
+                entry = FileEntry(filepath, relative, group, node.path)
+                self.files.append(entry)
+                grouped[group].append(entry)
+                node.items.append(entry)
+
+        self.groups = [(g, grouped[g]) for g in item_groups]
+        self.filters = [node.path for node in self.root.iter_filters()]
+
 def _add_file_nodes(parent_node, project):
-    filemap = project.files
-    project_path = project.filepath
-    src_root = project.src_root
-    strip_path = project.strip_path
-    filters = { '' : parent_node } # Parent of the empty filter
-    def get_filterparent(total_filter):
-        assert total_filter != '/', 'Illegal input'
-        if total_filter in filters:
-            return filters[total_filter]
-        result = os.path.split(total_filter)
-        if len(result) > 1:
-            parent_string = result[0]
-            child_string = result[1]
-        else:
-            parent_string = ''
-            child_string = total_filter
-
-        parent = get_filterparent(parent_string)
-        newfilter = ET.SubElement(parent, 'Filter', Name = child_string)
-        filters[total_filter] = newfilter
-        return newfilter
-
-    filetype_first = True
-
-    for f in filemap:
-        type_filter = f
-        for filepath in filemap[f]:
-            result = os.path.split(filepath)
-            subfolder = None
-            if len(result) > 1:
-                subfolder = result[0]
-            subfolder = _strip_folder(subfolder, strip_path)
-            if filetype_first:
-                total_filter = type_filter
-                if subfolder:
-                    if total_filter:
-                        total_filter += '/'
-                    total_filter += subfolder
+    # Walks the filter tree, adding the Filter and File elements of each
+    # filter in the order they were first met in the file map
+    stack = [(project.get_file_model().root, parent_node)]
+    while stack:
+        node, element = stack.pop()
+        for item in node.items:
+            if isinstance(item, FilterNode):
+                stack.append((item, ET.SubElement(element, 'Filter', Name = item.name)))
             else:
-                total_filter = ''
-                if subfolder:
-                    total_filter += subfolder
-                if type_filter:
-                    if total_filter:
-                        total_filter += '/'
-                    total_filter += type_filter
-
-            filterparent = get_filterparent(total_filter)
-            if src_root is not None:
-                filepath = os.path.join(src_root, filepath)
-            filepath = filepath.replace('/', '\\')
-            relative = os.path.relpath(filepath, os.path.split(project_path)[0])
-            ET.SubElement(filterparent, 'File', RelativePath = relative)
-    else:
-        #TODO: are projects without files valid?
-        pass
+                ET.SubElement(element, 'File', RelativePath = item.relative)
 
 def generate_xml_vc8(project):
     xml_project = ET.Element('VisualStudioProject',
@@ -312,28 +730,28 @@ def generate_xml_vc8(project):
     toolfiles = ET.SubElement(xml_project, 'ToolFiles')
 
     configurations = ET.SubElement(xml_project, 'Configurations')
-    for arch in project.archs:
-        for variant in project.variants:
-            configuration = ET.SubElement(
-                configurations,
-                'Configuration',
-                Name = '%s|%s' % (variant, arch),
-                ConfigurationType = str(configuration_types[project.configuration_type]),
-                #InheritedPropertySheets=".\foo.vsprops;.\bar.vsprops;",
-                UseOfMFC = "0",
-                ATLMinimizesCRunTimeLibraryUsage = "false",
-            )
-            tools = configuration_tools_vc8[project.configuration_type]
-            for tool in tools:
-                try:
-                    mapped_tool = tools_reverse_map_vc8[tool]
-                except KeyError:
-                    mapped_tool = tool
-                d = project.get_project_info(mapped_tool, variant, arch)
-                mapped_dict = {}
-                for k in d.keys():
-                    mapped_dict[properties_map_vc8[k]] = d[k]
-                tool_element = ET.SubElement(configuration, 'Tool', Name = tool, **mapped_dict)
+    for variant, arch in project.get_configurations():
+        configuration = ET.SubElement(
+            configurations,
+            'Configuration',
+            Name = '%s|%s' % (variant, arch),
+            ConfigurationType = str(configuration_types[project.configuration_type]),
+            #InheritedPropertySheets=".\foo.vsprops;.\bar.vsprops;",
+            UseOfMFC = "0",
+            ATLMinimizesCRunTimeLibraryUsage = "false",
+        )
+        tools = configuration_tools_vc8[project.configuration_type]
+        tools_reverse_map_vc8 = _get_tools_reverse_map_vc8()
+        for tool in tools:
+            try:
+                mapped_tool = tools_reverse_map_vc8[tool]
+            except KeyError:
+                mapped_tool = tool
+            d = project.get_project_info(mapped_tool, variant, arch)
+            mapped_dict = {}
+            for k in d.keys():
+                mapped_dict[properties_map_vc8[k]] = d[k]
+            tool_element = ET.SubElement(configuration, 'Tool', Name = tool, **mapped_dict)
 
     references = ET.SubElement(xml_project, 'References')
     files = ET.SubElement(xml_project, 'Files')
@@ -343,22 +761,51 @@ def generate_xml_vc8(project):
     xml_globals = ET.SubElement(xml_project, 'Globals')
     return xml_project
 
+def _configuration_condition(variant, arch):
+    return "'$(Configuration)|$(Platform)'=='%s|%s'" % (variant, arch)
+
+def _get_property_groups(project, entry, property_map, skip_empty):
+    """Returns (condition, properties) for each PropertyGroup to write for
+    entry of the project_info, with condition None for a group applying to
+    all configurations. Configurations without properties are left out if
+    skip_empty is set."""
+    groups = []
+    for variant, arch in project.get_configurations():
+        d = project.get_project_info(entry, variant, arch)
+        if not d and skip_empty:
+            continue
+        groups.append(([(variant, arch)], d))
+    if not project.collapse_properties:
+        return [(_configuration_condition(*c[0]), d) for c, d in groups]
+
+    merged = {}
+    result = []
+    for configurations, d in groups:
+        # The values as the generators write them
+        if skip_empty:
+            key = tuple(d.get(k) or '' for k in property_map)
+        else:
+            key = tuple(d[k] for k in property_map)
+        if key in merged:
+            merged[key][0].extend(configurations)
+        else:
+            merged[key] = (configurations, d)
+            result.append(merged[key])
+    if len(result) == 1 and len(result[0][0]) == len(project.get_configurations()):
+        return [(None, result[0][1])]
+    return [(' Or '.join(_configuration_condition(*c) for c in configurations), d)
+            for configurations, d in result]
+
 def get_file_groups(filemap):
-    text_files = []
-    header_files= []
-    cl_files = []
-    header_extensions = set(['.h', '.hpp', '.hxx', 'txx'])
-    cl_extensions = set(['.c', '.cpp', '.cxx'])
+    groups = {
+        'None' : [],
+        'ClCompile' : [],
+        'ClInclude' : [],
+    }
     for key in filemap.keys():
         for file in filemap[key]:
-            ext = os.path.splitext(file)[1].lower()
-            if ext in cl_extensions:
-                cl_files.append(file)
-            elif ext in header_extensions:
-                header_files.append(file)
-            else:
-                text_files.append(file)
-    return text_files, header_files, cl_files
+            groups[_get_file_group(file)].append(file)
+    return groups['None'], groups['ClInclude'], groups['ClCompile']
 
 def generate_xml_vc10(project):
     xml_project = ET.Element('Project',
@@ -368,14 +815,13 @@ def generate_xml_vc10(project):
     )
     # Configurations
     configurations = ET.SubElement(xml_project, 'ItemGroup', Label='ProjectConfigurations')
-    for arch in project.archs:
-        for variant in project.variants:
-            node = ET.SubElement(configurations, 'ProjectConfiguration',
-                Include='%s|%s' % (variant, arch))
-            configuration = ET.SubElement(node, 'Configuration')
-            configuration.text = variant
-            platform = ET.SubElement(node, 'Platform')
-            platform.text = arch
+    for variant, arch in project.get_configurations():
+        node = ET.SubElement(configurations, 'ProjectConfiguration',
+            Include='%s|%s' % (variant, arch))
+        configuration = ET.SubElement(node, 'Configuration')
+        configuration.text = variant
+        platform = ET.SubElement(node, 'Platform')
+        platform.text = arch
     # Globals
     globals = ET.SubElement(xml_project, 'PropertyGroup', Label='Globals')
     project_guid = ET.SubElement(globals, 'ProjectGuid')
@@ -385,64 +831,47 @@ def generate_xml_vc10(project):
     # Default properties
     default_props = ET.SubElement(xml_project, 'Import', Project="$(VCTargetsPath)\Microsoft.Cpp.Default.props")
     # Configuration properties
-    for arch in project.archs:
-        for variant in project.variants:
-            pg = ET.SubElement(xml_project, 'PropertyGroup',
-                Condition="'$(Configuration)|$(Platform)'=='%s|%s'" % (variant, arch),
-                Label='Configuration')
-            ct = ET.SubElement(pg, 'ConfigurationType')
-            ct.text = 'Makefile' # Hard coded
-            db = ET.SubElement(pg, 'UseDebugLibraries')
-            db.text = 'false' # Hard coded
-            ts = ET.SubElement(pg, 'PlatformToolset')
-            ts.text = get_toolset_version(project)
+    for variant, arch in project.get_configurations():
+        pg = ET.SubElement(xml_project, 'PropertyGroup',
+            Condition="'$(Configuration)|$(Platform)'=='%s|%s'" % (variant, arch),
+            Label='Configuration')
+        ct = ET.SubElement(pg, 'ConfigurationType')
+        ct.text = 'Makefile' # Hard coded
+        db = ET.SubElement(pg, 'UseDebugLibraries')
+        db.text = 'false' # Hard coded
+        ts = ET.SubElement(pg, 'PlatformToolset')
+        ts.text = get_toolset_version(project)
     # Cpp props
     cpp_props = ET.SubElement(xml_project, 'Import', Project="$(VCTargetsPath)\Microsoft.Cpp.props")
     # ExtensionSettings
     ext_settings = ET.SubElement(xml_project, 'ImportGroup', Label='ExtensionSettings')
     # PropertySheets
-    for arch in project.archs:
-        for variant in project.variants:
-            ig = ET.SubElement(xml_project, 'ImportGroup', Label='PropertySheets',
-                Condition="'$(Configuration)|$(Platform)'=='%s|%s'" % (variant, arch))
-            node = ET.SubElement(ig, 'Import', Project="$(UserRootDir)\Microsoft.Cpp.$(Platform).user.props",
-                Condition="exists('$(UserRootDir)\Microsoft.Cpp.$(Platform).user.props')",
-                Label="LocalAppDataPlatform")
+    for variant, arch in project.get_configurations():
+        ig = ET.SubElement(xml_project, 'ImportGroup', Label='PropertySheets',
+            Condition="'$(Configuration)|$(Platform)'=='%s|%s'" % (variant, arch))
+        node = ET.SubElement(ig, 'Import', Project="$(UserRootDir)\Microsoft.Cpp.$(Platform).user.props",
+            Condition="exists('$(UserRootDir)\Microsoft.Cpp.$(Platform).user.props')",
+            Label="LocalAppDataPlatform")
     # UserMacros
     user_macros = ET.SubElement(xml_project, 'PropertyGroup', Label='UserMacros')
     # Configuration properties
-    for arch in project.archs:
-        for variant in project.variants:
-            pg = ET.SubElement(xml_project, 'PropertyGroup',
-                Condition="'$(Configuration)|$(Platform)'=='%s|%s'" % (variant, arch))
-
-            d = project.get_project_info('make_properties', variant, arch)
-            for key in properties_map_vc10:
-                toolname = properties_map_vc10[key]
-                info = ET.SubElement(pg, toolname)
-                info.text = d[key]
+    for condition, d in _get_property_groups(project, 'make_properties', properties_map_vc10, False):
+        pg = ET.SubElement(xml_project, 'PropertyGroup')
+        if condition is not None:
+            pg.set('Condition', condition)
+
+        for key in properties_map_vc10:
+            toolname = properties_map_vc10[key]
+            info = ET.SubElement(pg, toolname)
+            info.text = d[key]
     # ItemDefinitionGroup
     idg = ET.SubElement(xml_project, 'ItemDefinitionGroup')
 
-    filemap = project.files
-    text_files, header_files, cl_files = get_file_groups(filemap)
-
     # Text, ClCompile and ClInclude files
-    groups = {
-        'None' : text_files,
-        'ClCompile' : cl_files,
-        'ClInclude' : header_files,
-    }
-    src_root = project.src_root
-    project_path = project.filepath
-    for g in groups.keys():
+    for g, entries in project.get_file_model().groups:
         ig = ET.SubElement(xml_project, 'ItemGroup')
-        for filepath in groups[g]:
-            if src_root is not None:
-                filepath = os.path.join(src_root, filepath)
-            filepath = filepath.replace('/', '\\')
-            relative = os.path.relpath(filepath, os.path.split(project_path)[0])
-            node = ET.SubElement(ig, g, Include=relative)
+        for entry in entries:
+            node = ET.SubElement(ig, g, Include=entry.relative)
 
     # targets
     targets = ET.SubElement(xml_project, 'Import', Project="$(VCTargetsPath)\Microsoft.Cpp.targets")
@@ -456,101 +885,266 @@ def generate_user_vc10(project):
         xmlns="http://schemas.microsoft.com/developer/msbuild/2003"
     )
     # User properties
-    for arch in project.archs:
-        for variant in project.variants:
-            d = project.get_project_info('user_properties', variant, arch)
-            if d:
-                pg = ET.SubElement(xml_project, 'PropertyGroup',
-                Condition="'$(Configuration)|$(Platform)'=='%s|%s'" % (variant, arch))
-                for key in user_map_vc10:
-                    if d.get(key):
-                        vc_name = user_map_vc10[key]
-                        info = ET.SubElement(pg, vc_name)
-                        info.text = d[key]
+    for condition, d in _get_property_groups(project, 'user_properties', user_map_vc10, True):
+        pg = ET.SubElement(xml_project, 'PropertyGroup')
+        if condition is not None:
+            pg.set('Condition', condition)
+        for key in user_map_vc10:
+            if d.get(key):
+                vc_name = user_map_vc10[key]
+                info = ET.SubElement(pg, vc_name)
+                info.text = d[key]
     return xml_project
 
 def generate_filters_vc10(project):
     xml_project = ET.Element('Project', ToolsVersion="4.0", xmlns="http://schemas.microsoft.com/developer/msbuild/2003")
 
-    filemap = project.files
-    project_path = project.filepath
-    src_root = project.src_root
-    strip_path = project.strip_path
-
-    text_files, header_files, cl_files = get_file_groups(filemap)
-
-    filter_map = {}
-    filters = set()
-    for f in filemap:
-        type_filter = f
-        for filepath in filemap[f]:
-            result = os.path.split(filepath)
-            subfolder = None
-            if len(result) > 1:
-                subfolder = result[0]
-            subfolder = _strip_folder(subfolder, strip_path)
-            filetype_first = True
-            if filetype_first:
-                total_filter = type_filter
-                if subfolder:
-                    if total_filter:
-                        total_filter += '/'
-                    total_filter += subfolder
-            else:
-                total_filter = ''
-                if subfolder:
-                    total_filter += subfolder
-                if type_filter:
-                    if total_filter:
-                        total_filter += '/'
-                    total_filter += type_filter
-            total_filter = total_filter.replace('/', '\\')
-            filter_map[filepath] = total_filter
-            filters.add(total_filter)
-
-            # If a filter 'foo\bar\chi' exists, we also have to make sure
-            # the filters 'foo' and  'foo\bar' exists. So generate any
-            # missing filters:
-            components = total_filter.split('\\')
-            for i in range(1, len(components)):
-                subfilter = '\\'.join(components[0:i])
-                filters.add(subfilter)
+    model = project.get_file_model()
 
     # First define the set of filters (can list the extensions for each filter)
     ig = ET.SubElement(xml_project, 'ItemGroup')
-    for filter in sorted(filters):
-        if filter == '':
-            continue
+    for filter in model.filters:
         fn = ET.SubElement(ig, 'Filter', Include = filter)
         uid = ET.SubElement(fn, 'UniqueIdentifier')
         uid.text = _generateGUID(project.filepath, filter)
 
-    groups = {
-        'None' : text_files,
-        'ClCompile' : cl_files,
-        'ClInclude' : header_files,
-    }
-
-    for g in groups.keys():
+    for g, entries in model.groups:
         ig = ET.SubElement(xml_project, 'ItemGroup')
-        for filepath in groups[g]:
-            filter = filter_map[filepath]
-            if src_root is not None:
-                filepath = os.path.join(src_root, filepath)
-            filepath = filepath.replace('/', '\\')
-            relative = os.path.relpath(filepath, os.path.split(project_path)[0])
-            node = ET.SubElement(ig, g, Include=relative)
-            if filter:
+        for entry in entries:
+            node = ET.SubElement(ig, g, Include=entry.relative)
+            if entry.filter:
                 fn = ET.SubElement(node, 'Filter')
-                fn.text = filter
+                fn.text = entry.filter
 
     return xml_project
 
+def _escape_xml_text(s):
+    # The escaping minidom used for text up to Python 3.12, kept so the
+    # output does not depend on the Python version
+    if '&' in s:
+        s = s.replace('&', '&amp;')
+    if '<' in s:
+        s = s.replace('<', '&lt;')
+    if '"' in s:
+        s = s.replace('"', '&quot;')
+    if '>' in s:
+        s = s.replace('>', '&gt;')
+    return s
+
+def _escape_xml_attribute(s):
+    # Parsers replace tabs and line breaks in attribute values with spaces,
+    # so they are escaped as character references, as minidom does since
+    # Python 3.13. Multi-line command lines of vc8 projects rely on it.
+    s = _escape_xml_text(s)
+    if '\t' in s:
+        s = s.replace('\t', '&#9;')
+    if '\n' in s:
+        s = s.replace('\n', '&#10;')
+    if '\r' in s:
+        s = s.replace('\r', '&#13;')
+    return s
+
+#====== String template backend for vc10 ======
+# Renders the same text as pretty-printing the trees of generate_xml_vc10
+# and generate_filters_vc10, without building the trees. Select it with
+# vc10_backend.
+
+vc10_backend = 'template'
+
+def _render_start_tag(indent, tag, attributes):
+    return '%s<%s%s' % (indent, tag, ''.join(' %s="%s"' % (k, _escape_xml_attribute(v)) for k, v in attributes))
+
+def _render_element(indent, tag, attributes, children = ''):
+    """Returns an element as _write_pretty_xml writes it, given the text of
+    its rendered children"""
+    start = _render_start_tag(indent, tag, attributes)
+    if children:
+        return '%s>\n%s%s</%s>\n' % (start, children, indent, tag)
+    return start + '/>\n'
+
+def _render_text_element(indent, tag, text, attributes = ()):
+    start = _render_start_tag(indent, tag, attributes)
+    if text:
+        return '%s>%s</%s>\n' % (start, _escape_xml_text(text), tag)
+    return start + '/>\n'
+
+class _Vc10Template():
+    """The constant parts of a vc10 project file, rendered once for a
+    combination of tools version, toolset and configurations"""
+
+    def __init__(self, tools_version, toolset, configurations):
+        xmlns = 'http://schemas.microsoft.com/developer/msbuild/2003'
+        head = [_render_start_tag('', 'Project', [('xmlns', xmlns), ('DefaultTargets', 'Build'), ('ToolsVersion', tools_version)]) + '>\n']
+        head.append(_render_element('\t', 'ItemGroup', [('Label', 'ProjectConfigurations')], ''.join(
+            _render_element('\t\t', 'ProjectConfiguration', [('Include', '%s|%s' % (variant, arch))],
+                _render_text_element('\t\t\t', 'Configuration', variant) +
+                _render_text_element('\t\t\t', 'Platform', arch))
+            for variant, arch in configurations)))
+        head.append('\t<PropertyGroup Label="Globals">\n')
+        self.head = ''.join(head)
+
+        body = [_render_text_element('\t\t', 'Keyword', 'MakeFileProj'), '\t</PropertyGroup>\n']
+        body.append(_render_element('\t', 'Import', [('Project', '$(VCTargetsPath)\\Microsoft.Cpp.Default.props')]))
+        for variant, arch in configurations:
+            body.append(_render_element('\t', 'PropertyGroup',
+                [('Condition', _configuration_condition(variant, arch)), ('Label', 'Configuration')],
+                _render_text_element('\t\t', 'ConfigurationType', 'Makefile') +
+                _render_text_element('\t\t', 'UseDebugLibraries', 'false') +
+                _render_text_element('\t\t', 'PlatformToolset', toolset)))
+        body.append(_render_element('\t', 'Import', [('Project', '$(VCTargetsPath)\\Microsoft.Cpp.props')]))
+        body.append(_render_element('\t', 'ImportGroup', [('Label', 'ExtensionSettings')]))
+        for variant, arch in configurations:
+            body.append(_render_element('\t', 'ImportGroup',
+                [('Label', 'PropertySheets'), ('Condition', _configuration_condition(variant, arch))],
+                _render_element('\t\t', 'Import', [
+                    ('Project', '$(UserRootDir)\\Microsoft.Cpp.$(Platform).user.props'),
+                    ('Condition', "exists('$(UserRootDir)\\Microsoft.Cpp.$(Platform).user.props')"),
+                    ('Label', 'LocalAppDataPlatform')])))
+        body.append(_render_element('\t', 'PropertyGroup', [('Label', 'UserMacros')]))
+        self.body = ''.join(body)
+
+        self.properties = [(key, '\t\t<%s>' % tag, '</%s>\n' % tag, '\t\t<%s/>\n' % tag)
+                           for key, tag in properties_map_vc10.items()]
+        self.tail = ''.join([
+            _render_element('\t', 'Import', [('Project', '$(VCTargetsPath)\\Microsoft.Cpp.targets')]),
+            _render_element('\t', 'ImportGroup', [('Label', 'ExtensionTargets')]),
+            '</Project>\n',
+        ])
+
+_vc10_templates = {}
+
+def _get_vc10_template(project):
+    tools_version = '4.0' if project.version <= 12.0 else '14.0'
+    key = (tools_version, get_toolset_version(project), project.get_configurations())
+    template = _vc10_templates.get(key)
+    if template is None:
+        template = _vc10_templates[key] = _Vc10Template(*key)
+    return template
+
+def _iter_vc10(project):
+    template = _get_vc10_template(project)
+    yield template.head
+    yield _render_text_element('\t\t', 'ProjectGuid', project.guid)
+    yield template.body
+    for condition, d in _get_property_groups(project, 'make_properties', properties_map_vc10, False):
+        if condition is None:
+            yield '\t<PropertyGroup>\n'
+        else:
+            yield _render_start_tag('\t', 'PropertyGroup', [('Condition', condition)]) + '>\n'
+        for key, open_tag, close_tag, empty in template.properties:
+            value = d[key]
+            if value:
+                yield open_tag + _escape_xml_text(value) + close_tag
+            else:
+                yield empty
+        yield '\t</PropertyGroup>\n'
+    yield '\t<ItemDefinitionGroup/>\n'
+    for g, entries in project.get_file_model().groups:
+        if entries:
+            yield '\t<ItemGroup>\n'
+            start = '\t\t<%s Include="' % g
+            for entry in entries:
+                yield start + _escape_xml_attribute(entry.relative) + '"/>\n'
+            yield '\t</ItemGroup>\n'
+        else:
+            yield '\t<ItemGroup/>\n'
+    yield template.tail
+
+def render_vc10(project):
+    """Returns the text of the project file, identical to pretty-printing
+    generate_xml_vc10(project), from precompiled templates. Only the
+    GUID, the make property groups and the files are rendered per
+    project."""
+    return ''.join(_iter_vc10(project))
+
+def _iter_filters_vc10(project):
+    model = project.get_file_model()
+    yield '<Project xmlns="http://schemas.microsoft.com/developer/msbuild/2003" ToolsVersion="4.0">\n'
+    if model.filters:
+        yield '\t<ItemGroup>\n'
+        for filter in model.filters:
+            yield '\t\t<Filter Include="%s">\n' % _escape_xml_attribute(filter)
+            yield _render_text_element('\t\t\t', 'UniqueIdentifier', _generateGUID(project.filepath, filter))
+            yield '\t\t</Filter>\n'
+        yield '\t</ItemGroup>\n'
+    else:
+        yield '\t<ItemGroup/>\n'
+    for g, entries in model.groups:
+        if entries:
+            yield '\t<ItemGroup>\n'
+            start = '\t\t<%s Include="' % g
+            for entry in entries:
+                if entry.filter:
+                    yield '%s%s">\n\t\t\t<Filter>%s</Filter>\n\t\t</%s>\n' % (
+                        start, _escape_xml_attribute(entry.relative), _escape_xml_text(entry.filter), g)
+                else:
+                    yield start + _escape_xml_attribute(entry.relative) + '"/>\n'
+            yield '\t</ItemGroup>\n'
+        else:
+            yield '\t<ItemGroup/>\n'
+    yield '</Project>\n'
+
+def render_filters_vc10(project):
+    """Returns the text of the .filters file, identical to pretty-printing
+    generate_filters_vc10(project)"""
+    return ''.join(_iter_filters_vc10(project))
+
+def _iter_pretty_xml(elem, indent = ''):
+    """Yields the text of elem indented with tabs, one node per line. The
+    output is what minidom's toprettyxml() produces for the same tree, with
+    text escaped as up to Python 3.12 and attributes as since 3.13, but
+    does not require serializing and re-parsing the whole document. Uses
+    a stack instead of recursion, so any depth works."""
+    # Holds the elements still to write and, as strings, the text to
+    # write once their children are done
+    stack = [(elem, indent)]
+    while stack:
+        item = stack.pop()
+        if type(item) is str:
+            yield item
+            continue
+        elem, indent = item
+        tag = elem.tag
+        start = [indent, '<', tag]
+        attributes = elem.items()
+        if 'xmlns' in elem.attrib:
+            # The parser minidom relies on reports namespace declarations first
+            attributes = sorted(attributes, key = lambda item: not item[0].startswith('xmlns'))
+        for key, value in attributes:
+            start.append(' %s="%s"' % (key, _escape_xml_attribute(value)))
+        text = elem.text
+        if len(elem):
+            start.append('>\n')
+            yield ''.join(start)
+            child_indent = indent + '\t'
+            if text:
+                yield _escape_xml_text(child_indent + text + '\n')
+            stack.append('%s</%s>\n' % (indent, tag))
+            for child in reversed(elem):
+                if child.tail:
+                    stack.append(_escape_xml_text(child_indent + child.tail + '\n'))
+                stack.append((child, child_indent))
+        elif text:
+            start.append('>%s</%s>\n' % (_escape_xml_text(text), tag))
+            yield ''.join(start)
+        else:
+            start.append('/>\n')
+            yield ''.join(start)
+
+def _write_pretty_xml(elem, write, indent = ''):
+    for text in _iter_pretty_xml(elem, indent):
+        write(text)
+
 def write_xml(xml, filepath, encoding, pretty):
-    if pretty:
-        s = ET.tostring(xml)
-        with codecs.open(filepath, 'w', encoding = encoding) as out:
-            out.write(minidom.parseString(s).toprettyxml())
+    if not hasattr(xml, 'tag'):
+        # Text from a template backend, such as render_vc10
+        with codecs.open(filepath, 'w', encoding = encoding, errors = 'xmlcharrefreplace') as out:
+            out.write('<?xml version="1.0" encoding="%s"?>\n' % encoding)
+            out.write(xml)
+    elif pretty:
+        with codecs.open(filepath, 'w', encoding = encoding, errors = 'xmlcharrefreplace') as out:
+            out.write('<?xml version="1.0" encoding="%s"?>\n' % encoding)
+            _write_pretty_xml(xml, out.write)
     else:
         doc = ET.ElementTree(xml)
 
@@ -561,77 +1155,1168 @@ def write_xml(xml, filepath, encoding, pretty):
                 doc.write(out, encoding = encoding)
         else:
             # doc.write doesn't work with python 3 due to some weird interference
-            # with scons and file writing.
-            # This leaves out the encoding tag.
-            doc.write(filepath, encoding = encoding)
+            # with scons and file writing, so let it open the file itself.
+            doc.write(filepath, encoding = encoding, xml_declaration = True)
 
-def write_project(project, filepath):
-    encoding = 'utf-8'
-    pretty = True
+_clock = getattr(time, 'perf_counter', time.time)
 
-    if project.version <= 9.0:
-        xml_project = generate_xml_vc8(project)
-        xml_filters = None
-        xml_user = None
+class _Span():
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.add_span(self.name, self.start, _clock(), self.args)
+
+class Tracer():
+    """Collects timed spans and counters from write_project, write_solution
+    and write_all. Pass a Tracer to those functions, or set default_tracer
+    to trace everything. The collected data can be saved in the Chrome
+    trace event format, which trace viewers such as chrome://tracing and
+    Perfetto can open.
+
+    Spans are recorded for computing the file model, and for rendering and
+    writing each file. The counters are files, filters, configurations,
+    projects and bytes_written."""
+
+    def __init__(self):
+        import threading
+        self._get_thread = threading.current_thread
+        self.origin = _clock()
+        self.spans = []
+        self.counters = {}
+        self.counter_events = []
+
+    def span(self, name, **args):
+        """Returns a context manager timing the code it wraps"""
+        return _Span(self, name, args)
+
+    def add_span(self, name, start, end, args):
+        self.spans.append((name, start, end, self._get_thread().ident, args))
+
+    def count(self, name, value = 1):
+        total = self.counters.get(name, 0) + value
+        self.counters[name] = total
+        self.counter_events.append((name, _clock(), total))
+
+    def get_trace_events(self):
+        pid = os.getpid()
+        def microseconds(t):
+            return int((t - self.origin) * 1e6)
+        events = []
+        for name, start, end, tid, args in self.spans:
+            events.append({
+                'name' : name,
+                'cat' : 'msvc',
+                'ph' : 'X',
+                'ts' : microseconds(start),
+                'dur' : microseconds(end) - microseconds(start),
+                'pid' : pid,
+                'tid' : tid,
+                'args' : args,
+            })
+        for name, t, total in self.counter_events:
+            events.append({
+                'name' : name,
+                'cat' : 'msvc',
+                'ph' : 'C',
+                'ts' : microseconds(t),
+                'pid' : pid,
+                'args' : {name : total},
+            })
+        events.sort(key = lambda event: event['ts'])
+        return events
+
+    def save(self, filepath):
+        """Writes the spans and counters as a Chrome trace event file"""
+        import json
+        with open(filepath, 'w') as out:
+            json.dump({'traceEvents' : self.get_trace_events(), 'displayTimeUnit' : 'ms'}, out)
+
+class _NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+class _NullTracer():
+    _span = _NullSpan()
+
+    def span(self, name, **args):
+        return self._span
+
+    def count(self, name, value = 1):
+        pass
+
+_null_tracer = _NullTracer()
+
+# Set to a Tracer to trace all generation that is not given a tracer
+default_tracer = None
+
+def _get_tracer(tracer):
+    if tracer is not None:
+        return tracer
+    if default_tracer is not None:
+        return default_tracer
+    return _null_tracer
+
+def _render_xml(xml, encoding):
+    """Returns the pretty-printed document as encoded bytes, the same as
+    write_xml would write to a file. xml may also be the text of the
+    document from a template backend."""
+    chunks = ['<?xml version="1.0" encoding="%s"?>\n' % encoding]
+    if hasattr(xml, 'tag'):
+        _write_pretty_xml(xml, chunks.append)
     else:
-        xml_project = generate_xml_vc10(project)
-        xml_filters = generate_filters_vc10(project)
-        xml_user    = generate_user_vc10(project)
-
-    # == write resulting xml ==
-    write_xml(xml_project, filepath, encoding, pretty)
-    if xml_filters:
-        write_xml(xml_filters, filepath + '.filters', encoding, pretty)
-    if xml_user:
-        write_xml(xml_user, filepath + '.user', encoding, pretty)
-
-def write_solution(version, projects, variants, archs, dependencies, out, solution_items = None):
-    out.write(sln_headers[version])
+        chunks.append(xml)
+    return ''.join(chunks).encode(encoding, 'xmlcharrefreplace')
+
+def _render_text_file(text):
+    """Encodes text the same way as writing it to a file opened in text mode"""
+    import locale
+    if os.linesep != '\n':
+        text = text.replace('\n', os.linesep)
+    return text.encode(locale.getpreferredencoding(False))
+
+_replace_file = getattr(os, 'replace', os.rename)
+
+def _remove_quietly(filepath):
+    try:
+        os.remove(filepath)
+    except OSError:
+        pass
+
+def _write_temp(filepath, chunks):
+    """Writes the byte strings in chunks to a new temporary file next to
+    filepath and returns its path. If writing or producing the chunks
+    fails, the temporary file is removed."""
+    import binascii
+    temp = '%s.%s.tmp' % (filepath, binascii.hexlify(os.urandom(4)).decode('ascii'))
+    try:
+        with open(temp, 'wb') as out:
+            for chunk in chunks:
+                out.write(chunk)
+    except:
+        _remove_quietly(temp)
+        raise
+    return temp
+
+def _fsync_file(filepath):
+    fd = os.open(filepath, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _fsync_dir(path):
+    # Makes renames in the directory durable. Directories cannot be opened
+    # on Windows, where NTFS journals the renames.
+    if os.name == 'nt':
+        return
+    fd = os.open(path or os.curdir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _atomic_write(filepath, data):
+    """Writes data to a temporary file next to filepath, then renames it
+    over filepath, so readers never see a partially written file. data is
+    a byte string, or an iterable of them."""
+    if isinstance(data, bytes):
+        data = [data]
+    temp = _write_temp(filepath, data)
+    try:
+        _replace_file(temp, filepath)
+    except OSError:
+        os.remove(temp)
+        raise
+
+def _stat_entry(filepath, digest):
+    st = os.stat(filepath)
+    return [digest, st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime)]
+
+def _check_file(filepath, data, entry):
+    """Returns (digest, current), where current is the entry of filepath if
+    it already holds exactly data, and None if it must be written. entry is
+    the manifest entry of the previous run, if any."""
+    import hashlib
+    digest = hashlib.sha1(data).hexdigest()
+    try:
+        current = _stat_entry(filepath, digest)
+    except OSError:
+        current = None
+    if current is not None and current[1] == len(data):
+        if entry == current:
+            # Same content as last time and the file was not touched since
+            return digest, current
+        with open(filepath, 'rb') as f:
+            if f.read() == data:
+                return digest, current
+    return digest, None
+
+def _update_file(filepath, data, entry):
+    """Writes data to filepath unless the file already holds exactly that
+    content. entry is the manifest entry of the previous run, if any.
+    Returns (written, new_entry)."""
+    digest, current = _check_file(filepath, data, entry)
+    if current is not None:
+        return False, current
+    _atomic_write(filepath, data)
+    return True, _stat_entry(filepath, digest)
+
+class OutputManifest():
+    """Records the generated files and their content hashes in a small JSON
+    file, so files that would be rewritten with identical content can be
+    left alone. Files without a matching manifest entry are compared byte
+    by byte instead.
+
+    Use as a context manager, or call close() when done: generated files
+    listed in the previous manifest but not updated during this run are
+    removed then, unless they have been modified since. Afterwards the
+    written, skipped and removed attributes list the affected files.
+
+    With filepath set to None the manifest is only kept in memory, which
+    suits long-running processes generating the same files repeatedly."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.root = os.path.split(os.path.abspath(filepath or os.curdir))[0]
+        self.previous = {}
+        if filepath is not None and os.path.exists(filepath):
+            import json
+            with open(filepath) as f:
+                self.previous = json.load(f).get('files', {})
+        self.entries = {}
+        self.written = []
+        self.skipped = []
+        self.removed = []
+
+    def _key(self, filepath):
+        return os.path.relpath(os.path.abspath(filepath), self.root).replace(os.sep, '/')
+
+    def get_entry(self, filepath):
+        key = self._key(filepath)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.previous.get(key)
+        return entry
+
+    def record(self, filepath, written, entry):
+        """Records the outcome of an _update_file call made elsewhere"""
+        self.entries[self._key(filepath)] = entry
+        if written:
+            self.written.append(filepath)
+        else:
+            self.skipped.append(filepath)
+
+    def keep(self, filepath):
+        """Carries the previous entry of a file over to this run, for files
+        that failed to generate, so close() does not remove them as stale"""
+        key = self._key(filepath)
+        if key not in self.entries and key in self.previous:
+            self.entries[key] = self.previous[key]
+
+    def update(self, filepath, data):
+        """Writes the bytes in data to filepath if its content differs.
+        Returns True if the file was written."""
+        written, entry = _update_file(filepath, data, self.get_entry(filepath))
+        self.record(filepath, written, entry)
+        return written
+
+    def close(self, remove_stale = True):
+        import json
+        if remove_stale:
+            for key in sorted(set(self.previous) - set(self.entries)):
+                filepath = os.path.join(self.root, key.replace('/', os.sep))
+                try:
+                    unmodified = _stat_entry(filepath, self.previous[key][0]) == self.previous[key]
+                except OSError:
+                    continue
+                if unmodified:
+                    os.remove(filepath)
+                    self.removed.append(filepath)
+        else:
+            for key in self.previous:
+                self.entries.setdefault(key, self.previous[key])
+        if self.filepath is None:
+            return
+        _prepare_dirs(self.filepath)
+        _atomic_write(self.filepath, json.dumps({'files' : self.entries}, indent = 1, sort_keys = True).encode('utf-8'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Only remove stale files after a complete run
+        self.close(remove_stale = exc_type is None)
+
+class FileWriter():
+    """Writes files in a pool of threads, so that generating the next files
+    overlaps with writing the previous ones. write() queues the data and
+    only blocks while queue_size files are waiting, which bounds the memory
+    held by the queue.
+
+    Each thread takes up to batch files from the queue at a time, writes
+    them to temporary files and renames them over the targets, so an
+    interrupted run never leaves partially written files behind. With
+    fsync set, the temporary files of a batch are synced together before
+    the renames, and each directory once after them, which makes the
+    output durable at a fraction of the cost of syncing file by file.
+
+    If an OutputManifest is given, files whose content did not change are
+    not written, and the manifest records the outcome of each file. close()
+    waits for the queued files and returns a list of (filepath, error)
+    tuples in the order of the write() calls, with error set to None for
+    files that were written or did not need to be."""
+
+    def __init__(self, threads = 4, queue_size = 64, batch = 16, fsync = True, manifest = None, tracer = None):
+        import threading
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        self._empty = queue.Empty
+        self.queue = queue.Queue(queue_size)
+        self.batch = batch
+        self.fsync = fsync
+        self.manifest = manifest
+        self.tracer = _get_tracer(tracer)
+        self._lock = threading.Lock()
+        self._results = []
+        self._count = 0
+        self._closed = False
+        self._aborted = False
+        self._threads = []
+        for i in range(threads):
+            thread = threading.Thread(target = self._run, name = 'FileWriter-%d' % i)
+            # Does not keep the interpreter alive if the main thread dies
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def write(self, filepath, data):
+        """Queues the bytes in data to be written to filepath"""
+        if self._closed:
+            raise ValueError('write to closed FileWriter')
+        self.queue.put((self._count, filepath, data))
+        self._count += 1
+
+    def close(self, abort = False):
+        """Waits for the threads to finish and returns the results. With
+        abort set, the files still in the queue are dropped."""
+        if not self._closed:
+            self._closed = True
+            self._aborted = abort
+            for thread in self._threads:
+                self.queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._results.sort()
+        return [result[1:] for result in self._results]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(abort = exc_type is not None)
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            while items[-1] is not None and len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except self._empty:
+                    break
+            stop = items[-1] is None
+            if stop:
+                items.pop()
+            if items and not self._aborted:
+                with self.tracer.span('write_batch', files = len(items)):
+                    try:
+                        self._write_batch(items)
+                    except Exception as e:
+                        self._fail_unrecorded(items, _format_error(e))
+            if stop:
+                return
+
+    def _fail_unrecorded(self, items, error):
+        with self._lock:
+            recorded = set(result[0] for result in self._results)
+        for index, filepath, data in items:
+            if index not in recorded:
+                self._record(index, filepath, error)
+
+    def _record(self, index, filepath, error, written = None, entry = None):
+        with self._lock:
+            self._results.append((index, filepath, error))
+            if self.manifest is not None:
+                if written is not None:
+                    self.manifest.record(filepath, written, entry)
+                elif error is not None:
+                    self.manifest.keep(filepath)
+
+    def _write_batch(self, items):
+        # Any error is recorded for its file, as an exception escaping
+        # would end the thread and leave write() and close() blocked on
+        # the queue
+        pending = []
+        try:
+            for index, filepath, data in items:
+                try:
+                    entry = None
+                    if self.manifest is not None:
+                        with self._lock:
+                            entry = self.manifest.get_entry(filepath)
+                    digest, current = _check_file(filepath, data, entry)
+                    if current is not None:
+                        self._record(index, filepath, None, False, current)
+                        continue
+                    pending.append((index, filepath, digest, len(data), _write_temp(filepath, [data])))
+                except Exception as e:
+                    self._record(index, filepath, _format_error(e))
+
+            if self.fsync:
+                for item in list(pending):
+                    try:
+                        _fsync_file(item[4])
+                    except Exception as e:
+                        pending.remove(item)
+                        _remove_quietly(item[4])
+                        self._record(item[0], item[1], _format_error(e))
+
+            dirs = set()
+            while pending:
+                index, filepath, digest, size, temp = pending.pop(0)
+                try:
+                    _replace_file(temp, filepath)
+                except Exception as e:
+                    _remove_quietly(temp)
+                    self._record(index, filepath, _format_error(e))
+                    continue
+                dirs.add(os.path.dirname(filepath))
+                try:
+                    entry = _stat_entry(filepath, digest)
+                except OSError:
+                    entry = None
+                self._record(index, filepath, None, True, entry)
+                with self._lock:
+                    self.tracer.count('bytes_written', size)
+        finally:
+            for index, filepath, digest, size, temp in pending:
+                _remove_quietly(temp)
+
+        if self.fsync:
+            for d in dirs:
+                try:
+                    _fsync_dir(d)
+                except OSError:
+                    pass
+
+# Part of the keys of ProjectCache. Change it whenever the generated files
+# change for the same input, so that no outdated output is reused.
+generator_version = 1
+
+class ProjectCache():
+    """Keeps the rendered files of projects in a directory, keyed by a hash
+    of everything the files are generated from (see get_key). A project
+    whose inputs did not change since it was last rendered is written from
+    the cache, without computing its file model or any XML.
+
+    The cache is bounded to about max_bytes: evict() removes the least
+    recently used entries beyond that, using the modification times of the
+    entry files, which are refreshed on each use. It is safe to use from
+    several processes, as entries are written atomically."""
+
+    def __init__(self, directory, max_bytes = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get_key(self, project, encoding = 'utf-8'):
+        """Returns the hex digest of the inputs of the project: its paths,
+        name, GUID, file map (in its order, which is the order of the
+        output), project_info, configurations, versions and options, the
+        GUIDs stored for it in guid_registry, generator_version and the
+        encoding of the files"""
+        import hashlib
+        import json
+        inputs = [
+            generator_version,
+            encoding,
+            project.filepath,
+            project.name,
+            project.guid,
+            project.src_root,
+            project.strip_path,
+            project.version,
+            project.toolset_version,
+            project.archs,
+            project.variants,
+            list(project.files.items()),
+            project.project_info,
+            project.merge_project_info,
+            project.collapse_properties,
+            guid_registry.get_stored(project.filepath),
+        ]
+        data = json.dumps(inputs, sort_keys = True, default = repr)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Returns the [(kind, data)] stored for key, or None"""
+        import json
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                outputs = [(kind, f.read(size)) for kind, size in header['files']]
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        for (kind, data), (_, size) in zip(outputs, header['files']):
+            if len(data) != size:
+                # Truncated, e.g. by a full disk
+                return None
+        return outputs
+
+    def put(self, key, outputs):
+        import json
+        path = self._get_path(key)
+        header = json.dumps({'files' : [[kind, len(data)] for kind, data in outputs]})
+        try:
+            _prepare_dirs(path)
+            _atomic_write(path, [header.encode('utf-8') + b'\n'] + [data for kind, data in outputs])
+        except (IOError, OSError):
+            # The cache is only an optimization
+            pass
+
+    def render(self, project, tracer = _null_tracer, encoding = 'utf-8'):
+        """Returns the (kind, data) pairs of the files of the project, from
+        the cache if possible, otherwise rendering and storing them"""
+        key = self.get_key(project, encoding)
+        outputs = self.get(key)
+        if outputs is not None:
+            tracer.count('cache_hits')
+            return outputs
+        tracer.count('cache_misses')
+        _count_project(project, tracer)
+        outputs = []
+        for kind in get_project_kinds(project):
+            with tracer.span('render_file', kind = kind):
+                outputs.append((kind, b''.join(iter_project_xml(project, kind, encoding))))
+        self.put(key, outputs)
+        return outputs
+
+    def evict(self):
+        """Removes the least recently used entries until the cache holds at
+        most max_bytes. Returns the number of entries removed."""
+        entries = []
+        total = 0
+        if not os.path.isdir(self.directory):
+            return 0
+        for subdir in os.listdir(self.directory):
+            path = os.path.join(self.directory, subdir)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                filepath = os.path.join(path, name)
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filepath))
+                total += st.st_size
+        removed = 0
+        entries.sort()
+        for mtime, size, filepath in entries:
+            if total <= self.max_bytes:
+                break
+            _remove_quietly(filepath)
+            total -= size
+            removed += 1
+        return removed
+
+def _prepare_dirs(filepath):
+    d = os.path.split(filepath)[0]
+    if d and not os.path.exists(d):
+        try:
+            os.makedirs(d)
+        except OSError:
+            # May have been created by another process in the meantime
+            if not os.path.isdir(d):
+                raise
+
+# The kinds of files making up a project, and their suffixes
+project_file_suffixes = {
+    'project' : '',
+    'filters' : '.filters',
+    'user'    : '.user',
+}
+
+def get_project_kinds(project):
+    """Returns the kinds of the files making up the project, see
+    project_file_suffixes"""
+    if project.version <= 9.0:
+        return ['project']
+    kinds = ['project', 'filters']
+    if _get_property_groups(project, 'user_properties', user_map_vc10, True):
+        kinds.append('user')
+    return kinds
+
+def _iter_project_text(project, kind):
+    if kind not in project_file_suffixes or (project.version <= 9.0 and kind != 'project'):
+        raise ValueError('No %r file for version %s' % (kind, project.version))
+    if project.version <= 9.0:
+        return _iter_pretty_xml(generate_xml_vc8(project))
+    if kind == 'project':
+        if vc10_backend == 'template':
+            return _iter_vc10(project)
+        return _iter_pretty_xml(generate_xml_vc10(project))
+    if kind == 'filters':
+        if vc10_backend == 'template':
+            return _iter_filters_vc10(project)
+        return _iter_pretty_xml(generate_filters_vc10(project))
+    return _iter_pretty_xml(generate_user_vc10(project))
+
+def iter_project_xml(project, kind = 'project', encoding = 'utf-8', chunk_size = 65536):
+    """Yields one of the files of a project, as encoded byte strings of
+    about chunk_size bytes, starting with the XML declaration. kind is one
+    of get_project_kinds(project).
+
+    With the template backend the project and filter files are rendered
+    as they are consumed, so memory use is bounded by chunk_size and the
+    FileModel. Other files are rendered from their tree."""
+    # One encoder for the whole file, so encodings with a byte order mark
+    # write it only once
+    encode = codecs.getincrementalencoder(encoding)('xmlcharrefreplace').encode
+    pieces = ['<?xml version="1.0" encoding="%s"?>\n' % encoding]
+    size = 0
+    for piece in _iter_project_text(project, kind):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield encode(''.join(pieces))
+            pieces = []
+            size = 0
+    yield encode(''.join(pieces), True)
+
+def _count_project(project, tracer):
+    with tracer.span('file_model'):
+        model = project.get_file_model()
+    tracer.count('files', len(model.files))
+    tracer.count('filters', len(model.filters))
+    tracer.count('configurations', len(project.variants) * len(project.archs))
+
+def write_project(project, filepath, manifest = None, tracer = None, writer = None, cache = None):
+    """Writes the project files, streaming them through iter_project_xml
+    into temporary files that are renamed into place. If an OutputManifest
+    is given, files are only rewritten if their content changed. Timings
+    and counters are reported to the Tracer given, or to default_tracer.
+
+    If a FileWriter is given, the rendered files are queued on it instead,
+    and the manifest of the writer applies. If a ProjectCache is given,
+    the files are taken from it when the project did not change."""
+    tracer = _get_tracer(tracer)
+    encoding = 'utf-8'
+
+    with tracer.span('write_project', project = project.name):
+        tracer.count('projects')
+        if cache is not None:
+            outputs = cache.render(project, tracer, encoding)
+        else:
+            _count_project(project, tracer)
+            outputs = [(kind, None) for kind in get_project_kinds(project)]
+        for kind, data in outputs:
+            path = filepath + project_file_suffixes[kind]
+            if data is None:
+                chunks = iter_project_xml(project, kind, encoding)
+                if writer is None and manifest is None:
+                    with tracer.span('write_file', file = path):
+                        _atomic_write(path, chunks)
+                    tracer.count('bytes_written', os.path.getsize(path))
+                    continue
+                # The whole file is needed to compare it with the previous one
+                with tracer.span('render_file', file = path):
+                    data = b''.join(chunks)
+            if writer is not None:
+                writer.write(path, data)
+                continue
+            with tracer.span('write_file', file = path):
+                if manifest is not None:
+                    written = manifest.update(path, data)
+                else:
+                    _atomic_write(path, data)
+                    written = True
+            if written:
+                tracer.count('bytes_written', len(data))
+
+def _get_folder_guid(folder):
+    return _generateGUID(folder, 'Solution Folder')
+
+def _normalize_folder(folder):
+    return '/'.join(name for name in folder.replace('\\', '/').split('/') if name)
+
+def _iter_folders(project_folders):
+    """Yields (folder, name, parent) for the solution folders holding the
+    given normalized folders, parents first, with parent None at the top
+    level"""
+    seen = set()
+    for folder in project_folders:
+        parent = None
+        path = []
+        for name in folder.split('/'):
+            path.append(name)
+            current = '/'.join(path)
+            if current not in seen:
+                seen.add(current)
+                yield current, name, parent
+            parent = current
+
+def iter_solution(version, projects, variants, archs, dependencies, solution_items = None, chunk_lines = 4096, folders = None, encoding = None):
+    """Yields the text of the solution file in blocks of about chunk_lines
+    lines each. projects may be any iterable, including a generator: it is
+    iterated only once, and only the GUIDs of the projects are kept.
+
+    folders optionally maps projects to solution folders, given as paths
+    such as 'libraries/core' for nested folders.
+
+    With an encoding, the blocks are yielded as byte strings, the same as
+    writing the text to a file opened in text mode with that encoding."""
+    if encoding is not None:
+        encode = codecs.getincrementalencoder(encoding)().encode
+        for block in iter_solution(version, projects, variants, archs, dependencies, solution_items, chunk_lines, folders):
+            if os.linesep != '\n':
+                block = block.replace('\n', os.linesep)
+            yield encode(block)
+        yield encode('', True)
+        return
+    variants = list(variants)
+    archs = list(archs)
+    if folders is None:
+        folders = {}
+    guids = []
+    nested = []
+    guid = None
+    chunk = [sln_headers[version]]
     for project in projects:
         filepath = project.filepath
         guid = project.guid
+        guids.append(guid)
+        folder = _normalize_folder(folders.get(project) or '')
+        if folder:
+            nested.append((guid, folder))
         name = project.name
-        out.write('Project("%s") = "%s", "%s", "%s"\n' % ( external_makefile_guid, name, filepath.replace('/', '\\'), guid ))
+        chunk.append('Project("%s") = "%s", "%s", "%s"\n' % ( external_makefile_guid, name, filepath.replace('/', '\\'), guid ))
         deps = dependencies.get(project)
         if deps:
-            out.write('\tProjectSection(ProjectDependencies) = postProject\n')
+            chunk.append('\tProjectSection(ProjectDependencies) = postProject\n')
             for dep in deps:
                 guid = dep.guid
-                out.write('%s = %s\n' % (guid, guid))
-            out.write('\tEndProjectSection')
-        out.write('EndProject\n')
+                chunk.append('%s = %s\n' % (guid, guid))
+            chunk.append('\tEndProjectSection\n')
+        chunk.append('EndProject\n')
+        if len(chunk) >= chunk_lines:
+            yield ''.join(chunk)
+            chunk = []
+
+    folder_parents = []
+    for folder, name, parent in _iter_folders(sorted(set(folder for _, folder in nested))):
+        folder_guid = _get_folder_guid(folder)
+        chunk.append('Project("%s") = "%s", "%s", "%s"\nEndProject\n' % (solution_folder_guid, name, name, folder_guid))
+        if parent is not None:
+            folder_parents.append((folder_guid, _get_folder_guid(parent)))
 
     if (version > 10) and solution_items:
-        out.write('Project("%s") = "%s", "%s", "%s"\n' % ('{2150E333-8FDC-42A3-9474-1A3956D46DE8}', 'Solution Items',
-                                                          'Solution Items', guid))
-        out.write('\tProjectSection(SolutionItems) = preProject\n')
+        chunk.append('Project("%s") = "%s", "%s", "%s"\n' % (solution_folder_guid, 'Solution Items',
+                                                            'Solution Items', _get_folder_guid('Solution Items')))
+        chunk.append('\tProjectSection(SolutionItems) = preProject\n')
         for item in solution_items:
-            out.write('\t\t%s\n' % item)
-        out.write('\tEndProjectSection\n')
-        out.write('EndProject\n')
+            chunk.append('\t\t%s\n' % item)
+        chunk.append('\tEndProjectSection\n')
+        chunk.append('EndProject\n')
 
-    out.write('Global\n')
-    out.write('\tGlobalSection(SolutionConfigurationPlatforms) = preSolution\n')
+    chunk.append('Global\n')
+    chunk.append('\tGlobalSection(SolutionConfigurationPlatforms) = preSolution\n')
     for variant in variants:
         for arch in archs:
-            out.write('\t\t%s|%s = %s|%s\n' % (variant, arch, variant, arch))
-    out.write('\tEndGlobalSection\n')
+            chunk.append('\t\t%s|%s = %s|%s\n' % (variant, arch, variant, arch))
+    chunk.append('\tEndGlobalSection\n')
 
-    out.write('\tGlobalSection(ProjectConfigurationPlatforms) = postSolution\n')
+    chunk.append('\tGlobalSection(ProjectConfigurationPlatforms) = postSolution\n')
     for variant in variants:
         for arch in archs:
-            for p in projects:
-                filepath = p.filepath
-                guid = p.guid
-                for s in ['\t\t%s.%s|%s.ActiveCfg = %s|%s\n', '\t\t%s.%s|%s.Build.0 = %s|%s\n']:
-                    out.write(s % (guid,variant,arch,variant,arch))
-    out.write('\tEndGlobalSection\n')
+            # Only the GUID differs between the projects
+            active = '.%s|%s.ActiveCfg = %s|%s\n\t\t' % (variant, arch, variant, arch)
+            build = '.%s|%s.Build.0 = %s|%s\n' % (variant, arch, variant, arch)
+            for guid in guids:
+                chunk.append('\t\t' + guid + active + guid + build)
+                if len(chunk) >= chunk_lines:
+                    yield ''.join(chunk)
+                    chunk = []
+    chunk.append('\tEndGlobalSection\n')
+
+    chunk.append('\tGlobalSection(SolutionProperties) = preSolution\n')
+    chunk.append('\t\tHideSolutionNode = FALSE\n')
+    chunk.append('\tEndGlobalSection\n')
+
+    if nested:
+        chunk.append('\tGlobalSection(NestedProjects) = preSolution\n')
+        for child, parent in folder_parents:
+            chunk.append('\t\t%s = %s\n' % (child, parent))
+        for child, folder in nested:
+            chunk.append('\t\t%s = %s\n' % (child, _get_folder_guid(folder)))
+        chunk.append('\tEndGlobalSection\n')
+
+    chunk.append('EndGlobal\n')
+    yield ''.join(chunk)
+
+def _reduce_dependencies(dependencies):
+    try:
+        from . import depgraph
+    except ImportError:
+        import depgraph
+    return depgraph.reduce_dependencies(dependencies)
+
+def write_solution(version, projects, variants, archs, dependencies, out, solution_items = None, tracer = None, folders = None,
+                   reduce_dependencies = False):
+    """Writes the solution to the file object out. With reduce_dependencies
+    set, only the dependencies not implied by others are written, see
+    depgraph.reduce_dependencies, and a cycle raises DependencyCycleError."""
+    tracer = _get_tracer(tracer)
+    if reduce_dependencies:
+        dependencies = _reduce_dependencies(dependencies)
+    with tracer.span('write_solution'):
+        size = 0
+        for block in iter_solution(version, projects, variants, archs, dependencies, solution_items, folders = folders):
+            out.write(block)
+            size += len(block)
+        tracer.count('bytes_written', size)
+
+def get_dependency_closure(projects, dependencies):
+    """Returns the given projects followed by all the projects they depend
+    on, directly or indirectly, each listed once"""
+    result = []
+    seen = set()
+    stack = list(reversed(list(projects)))
+    while stack:
+        project = stack.pop()
+        if project in seen:
+            continue
+        seen.add(project)
+        result.append(project)
+        stack.extend(reversed(dependencies.get(project, [])))
+    return result
+
+def write_solution_filter(filepath, solution, projects, manifest = None):
+    """Writes a solution filter (.slnf) which loads only the given projects
+    of the solution at the path solution. Visual Studio 2019 and later open
+    solution filters of any solution, so teams can work on a slice of a
+    large solution, for instance the projects returned by
+    get_dependency_closure."""
+    import json
+    root = os.path.dirname(os.path.abspath(filepath))
+    solution_path = os.path.relpath(os.path.abspath(solution), root)
+    document = {
+        'solution' : {
+            'path' : solution_path.replace('/', '\\'),
+            'projects' : [p.filepath.replace('/', '\\') for p in projects],
+        }
+    }
+    data = (json.dumps(document, indent = 2) + '\n').encode('utf-8')
+    _prepare_dirs(filepath)
+    if manifest is not None:
+        manifest.update(filepath, data)
+    else:
+        _atomic_write(filepath, data)
+
+def _format_error(e):
+    return '%s: %s' % (e.__class__.__name__, e)
+
+def _write_project_job(job, tracer = _null_tracer):
+    """Writes the files of one project, returning (filepath, error) for each
+    file. Runs in the worker processes of write_all, or in the calling
+    process when there is no pool, in which case it reports to tracer.
 
-    out.write('\tGlobalSection(SolutionProperties) = preSolution\n')
-    out.write('\t\tHideSolutionNode = FALSE\n')
-    out.write('\tEndGlobalSection\n')
+    If entries is not None, it maps the file paths to their entries in the
+    previous OutputManifest and unchanged files are skipped. The results
+    then carry (written, new_entry) as a third element for successfully
+    written files. cache is a ProjectCache or None."""
+    project, filepath, entries, cache = job
+    encoding = 'utf-8'
+    tracer.count('projects')
+    try:
+        _prepare_dirs(filepath)
+        if cache is not None:
+            outputs = cache.render(project, tracer, encoding)
+        else:
+            _count_project(project, tracer)
+            outputs = [(kind, None) for kind in get_project_kinds(project)]
+    except Exception as e:
+        return [(filepath, _format_error(e))]
+    results = []
+    for kind, data in outputs:
+        path = filepath + project_file_suffixes[kind]
+        try:
+            if data is not None:
+                chunks = [data]
+            else:
+                chunks = iter_project_xml(project, kind, encoding)
+            if entries is None:
+                with tracer.span('write_file', file = path):
+                    _atomic_write(path, chunks)
+                tracer.count('bytes_written', os.path.getsize(path))
+                results.append((path, None))
+            else:
+                if data is None:
+                    with tracer.span('render_file', file = path):
+                        data = b''.join(chunks)
+                with tracer.span('write_file', file = path):
+                    update = _update_file(path, data, entries.get(path))
+                if update[0]:
+                    tracer.count('bytes_written', len(data))
+                results.append((path, None, update))
+        except Exception as e:
+            results.append((path, _format_error(e)))
+    return results
+
+def _get_manifest_entries(manifest, filepath):
+    if manifest is None:
+        return None
+    entries = {}
+    for suffix in project_file_suffixes.values():
+        entries[filepath + suffix] = manifest.get_entry(filepath + suffix)
+    return entries
+
+def _write_targets_job(job, tracer = _null_tracer):
+    """Writes a project once for each of its targets, returning the results
+    of _write_project_job for all of them. Runs in the worker processes of
+    write_all and write_versions, or in the calling process with tracer.
+
+    The targets are (version, toolset_version, relative, filepath, entries)
+    tuples, relative being the path of the project in the solution. With
+    version None the project is written as it is. The data derived from
+    the project is computed once and shared by the targets, unless they
+    are all found in the ProjectCache cache."""
+    project, targets, cache = job
+    if len(targets) > 1 and cache is None:
+        project.get_file_model()
+        project.get_configurations()
+        project.configurations
+    results = []
+    for version, toolset_version, relative, filepath, entries in targets:
+        target = project
+        if version is not None:
+            target = project.for_version(version, toolset_version, relative)
+        with tracer.span('write_project', project = target.name):
+            results.extend(_write_project_job((target, filepath, entries, cache), tracer))
+    return results
+
+def _write_solution_file(solution, manifest, tracer, **args):
+    """Writes a solution with write_solution, returning (filepath, error)"""
+    try:
+        _prepare_dirs(solution)
+        if manifest is not None:
+            import io
+            out = io.StringIO()
+        else:
+            out = open(solution, 'w')
+        with out:
+            write_solution(out = out, tracer = tracer, **args)
+            if manifest is not None:
+                manifest.update(solution, _render_text_file(out.getvalue()))
+        return (solution, None)
+    except Exception as e:
+        return (solution, _format_error(e))
+
+def _init_worker(stored):
+    # With the spawn start method, the default on Windows and macOS, the
+    # workers import the module afresh, without the GUIDs stored in or
+    # pinned to guid_registry
+    guid_registry.stored = stored
+    guid_registry._stored_by_file = None
+
+def _run_jobs(target_jobs, jobs, write_solutions, manifest, tracer, cache):
+    """Runs _write_targets_job on target_jobs in a pool of jobs processes,
+    calling write_solutions() in this process meanwhile. Without a pool
+    the jobs run in this process after write_solutions(), reporting to
+    the tracer. Returns the results of write_solutions followed by those
+    of the jobs, in order. Evicts old entries from the cache once done."""
+    import multiprocessing
+
+    tracer = _get_tracer(tracer)
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    pool = None
+    if jobs > 1 and len(target_jobs) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(target_jobs)), _init_worker, (guid_registry.stored,))
+    try:
+        if pool is not None:
+            chunksize = max(1, len(target_jobs) // (4 * jobs))
+            project_results = pool.imap(_write_targets_job, target_jobs, chunksize)
+        else:
+            project_results = (_write_targets_job(job, tracer) for job in target_jobs)
+
+        # The solutions are written while the pool works on the projects
+        results = write_solutions()
+
+        with tracer.span('wait_for_projects'):
+            project_results = list(project_results)
+        for project_result in project_results:
+            for result in project_result:
+                if len(result) > 2:
+                    manifest.record(result[0], *result[2])
+                results.append(result[:2])
+        if manifest is not None:
+            # A project failing before its first file is reported under
+            # the path of its project file, so its other files are kept too
+            for filepath, error in results:
+                if error is not None:
+                    for suffix in project_file_suffixes.values():
+                        manifest.keep(filepath + suffix)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if cache is not None:
+        cache.evict()
+    return results
+
+def write_all(solution, projects, dependencies = None, solution_items = None, jobs = None,
+              version = None, variants = None, archs = None, manifest = None, tracer = None, folders = None,
+              cache = None, reduce_dependencies = False):
+    """Writes the solution file and all its projects, generating the
+    projects in a pool of jobs processes (one per CPU by default).
+
+    The project file paths are taken relative to the directory of the
+    solution. Unless given, the solution version is that of the first
+    project, which requires at least one project, and the variants and
+    archs are those of all the projects.
+
+    Returns a list of (filepath, error) tuples, with error set to None for
+    files that were written successfully. The list starts with the solution
+    and follows the order of projects, independent of the number of jobs.
+
+    If an OutputManifest is given, only files whose content changed are
+    written, and the manifest records which files were written or skipped.
+
+    folders optionally puts projects in solution folders, see
+    iter_solution.
+
+    If a ProjectCache is given, unchanged projects are written from it, and
+    its least recently used entries are evicted at the end.
+
+    With reduce_dependencies set, the solution only lists the dependencies
+    not implied by others, and a dependency cycle raises
+    depgraph.DependencyCycleError before anything is written.
+
+    A Tracer only receives the spans and counters of the calling process,
+    which writes the solution and waits for the workers, and writes the
+    projects itself when jobs is 1 or there is a single project."""
+    projects = list(projects)
+    if dependencies is None:
+        dependencies = {}
+    if version is None:
+        if not projects:
+            raise ValueError('write_all needs a version for a solution without projects')
+        version = projects[0].version
+    if reduce_dependencies:
+        dependencies = _reduce_dependencies(dependencies)
+    if variants is None:
+        variants = _unique(v for p in projects for v in p.variants)
+    if archs is None:
+        archs = _unique(a for p in projects for a in p.archs)
+
+    root = os.path.split(solution)[0]
+    target_jobs = []
+    for p in projects:
+        filepath = os.path.join(root, p.filepath)
+        target_jobs.append((p, [(None, None, p.filepath, filepath, _get_manifest_entries(manifest, filepath))], cache))
+
+    def write_solutions():
+        return [_write_solution_file(solution, manifest, tracer,
+                                     version = version,
+                                     projects = projects,
+                                     variants = variants,
+                                     archs = archs,
+                                     dependencies = dependencies,
+                                     solution_items = solution_items,
+                                     folders = folders)]
+    return _run_jobs(target_jobs, jobs, write_solutions, manifest, tracer, cache)
+
+def get_version_filepath(filepath, version, tag = None):
+    """Returns the path of a project file for a Visual Studio version: the
+    extension is that of the version, preceded by tag if given, so
+    'foo.vcxproj' becomes 'foo.vs2015.vcxproj' with the tag 'vs2015'"""
+    root = os.path.splitext(filepath)[0]
+    if tag:
+        root += '.' + tag
+    return root + ('.vcproj' if version <= 9.0 else '.vcxproj')
+
+def write_versions(targets, projects, dependencies = None, solution_items = None, jobs = None,
+                   variants = None, archs = None, manifest = None, tracer = None, folders = None,
+                   cache = None, reduce_dependencies = False):
+    """Writes a solution and its projects for each of several Visual Studio
+    versions in one pass. targets is a list of (solution, version,
+    toolset_version, tag) tuples. The project files of each target are
+    named with get_version_filepath, so targets can share a directory if
+    their tags differ.
+
+    Each project is handled by a single job for all targets, so the file
+    model, filters and configuration matrix are computed once; only the
+    version specific parts are rendered per target. The projects keep
+    their GUIDs in all versions.
+
+    The other arguments are as for write_all. Returns the results of the
+    solutions in the order of targets, followed by those of the projects,
+    each with all its targets."""
+    projects = list(projects)
+    if dependencies is None:
+        dependencies = {}
+    if reduce_dependencies:
+        dependencies = _reduce_dependencies(dependencies)
+    if folders is None:
+        folders = {}
+    if variants is None:
+        variants = _unique(v for p in projects for v in p.variants)
+    if archs is None:
+        archs = _unique(a for p in projects for a in p.archs)
+
+    target_jobs = [(p, [], cache) for p in projects]
+    solutions = []
+    for solution, version, toolset_version, tag in targets:
+        root = os.path.split(solution)[0]
+        copies = {}
+        for p, project_targets, _ in target_jobs:
+            relative = get_version_filepath(p.filepath, version, tag)
+            filepath = os.path.join(root, relative)
+            project_targets.append((version, toolset_version, relative, filepath, _get_manifest_entries(manifest, filepath)))
+            copies[p] = p.for_version(version, toolset_version, relative)
+        def get_copy(p):
+            if p not in copies:
+                copies[p] = p.for_version(version, toolset_version, get_version_filepath(p.filepath, version, tag))
+            return copies[p]
+        solutions.append(dict(solution = solution,
+                              version = version,
+                              projects = [copies[p] for p in projects],
+                              variants = variants,
+                              archs = archs,
+                              dependencies = dict((get_copy(p), [get_copy(d) for d in deps]) for p, deps in dependencies.items()),
+                              solution_items = solution_items,
+                              folders = dict((get_copy(p), folder) for p, folder in folders.items())))
+
+    def write_solutions():
+        return [_write_solution_file(manifest = manifest, tracer = tracer, **args) for args in solutions]
+    return _run_jobs(target_jobs, jobs, write_solutions, manifest, tracer, cache)
 
-    out.write('EndGlobal\n')
 
 
 #====== Code for testing ======
@@ -685,11 +2370,6 @@ def _get_test_projects(variants, archs, version, toolset_version):
     }
     return projects, dependencies
 
-def _prepare_dirs(filepath):
-    d = os.path.split(filepath)[0]
-    if not os.path.exists(d):
-        os.makedirs(d)
-
 def _make_test_files(testroot, projects):
     for p in projects:
         for key in p.files:
@@ -700,7 +2380,338 @@ def _make_test_files(testroot, projects):
                 out.write('\n')
                 out.close()
 
+def test_vc10_backends():
+    """Checks that the template backend produces the same bytes as
+    pretty-printing the trees of generate_xml_vc10 and
+    generate_filters_vc10, and that iter_project_xml and iter_solution do
+    not depend on the chunk size, also with an encoding writing a byte
+    order mark"""
+    projects = []
+    for version, toolset_version in [(10.0, None), (12.0, None), (15.0, 14.2)]:
+        projects.extend(_get_test_projects(['Debug', 'Release'], ['Win32', 'x64'], version, toolset_version)[0])
+    escaped = dict(build_command_line='scons.bat "a&b" <c>',
+                   clean_command_line='',
+                   rebuild_command_line="it's",
+                   output='f\xf6\u20ac.exe',
+                   preprocessor_definitions='A=1;B="2"',
+                   include_search_path='')
+    projects.append(Project(filepath = 'odd & <names>/p.vcxproj',
+                            variants = ['Debug'],
+                            archs = ['Win32'],
+                            files = {'a&b' : ['x/y&z.cpp', 'x/"q".h'], 'tab\tbed' : ['x/two\nlines.cpp'], '' : ['\xe6.txt']},
+                            version = 15.0,
+                            project_info = {'project_type' : 'Makefile', 'make_properties' : escaped},
+                            guid = '{<&>}'))
+    projects.append(Project(filepath = 'empty.vcxproj',
+                            variants = [],
+                            archs = [],
+                            files = {},
+                            version = 15.0,
+                            project_info = {'project_type' : 'Makefile'}))
+    for project in projects:
+        for collapse in [False, True]:
+            project.collapse_properties = collapse
+            expected = _render_xml(generate_xml_vc10(project), 'utf-8')
+            actual = _render_xml(render_vc10(project), 'utf-8')
+            assert actual == expected, 'render_vc10 differs from generate_xml_vc10 for %s' % project.filepath
+        project.collapse_properties = False
+        expected = _render_xml(generate_filters_vc10(project), 'utf-8')
+        actual = _render_xml(render_filters_vc10(project), 'utf-8')
+        assert actual == expected, 'render_filters_vc10 differs from generate_filters_vc10 for %s' % project.filepath
+        for kind in get_project_kinds(project):
+            for encoding in ['utf-8', 'utf-16']:
+                expected = b''.join(iter_project_xml(project, kind, encoding, chunk_size = 1 << 30))
+                assert b''.join(iter_project_xml(project, kind, encoding, chunk_size = 1)) == expected
+    for encoding in ['utf-8', 'utf-16']:
+        args = (15.0, projects, ['Debug'], ['Win32'], {}, ['a.txt'])
+        expected = b''.join(iter_solution(*args, chunk_lines = 1 << 30, encoding = encoding))
+        assert b''.join(iter_solution(*args, chunk_lines = 1, encoding = encoding)) == expected
+    print('Checked the vc10 backends on %d projects' % len(projects))
+
+def test_xml_escaping():
+    """Checks that attribute values with tabs and line breaks survive
+    writing and parsing a project file"""
+    command = 'scons.bat\r\n\tcopy "a" b\nscons.bat <c>'
+    properties = dict(build_command_line = command,
+                      clean_command_line = '',
+                      rebuild_command_line = '',
+                      output = '',
+                      preprocessor_definitions = '',
+                      include_search_path = '')
+    for version in [9.0, 15.0]:
+        ext = 'vcproj' if version <= 9.0 else 'vcxproj'
+        project = Project(filepath = 'p.%s' % ext,
+                          variants = ['Debug'],
+                          archs = ['Win32'],
+                          files = {'a\tb' : ['x/two\nlines.cpp']},
+                          version = version,
+                          project_info = {'project_type' : 'Makefile', 'make_properties' : properties})
+        if version <= 9.0:
+            root = ET.fromstring(_render_xml(generate_xml_vc8(project), 'utf-8'))
+            values = [e.get('BuildCommandLine') for e in root.iter() if e.get('BuildCommandLine') is not None]
+            assert values == [command], values
+            files = [e.get('RelativePath') for e in root.iter() if e.get('RelativePath') is not None]
+        else:
+            root = ET.fromstring(b''.join(iter_project_xml(project, 'filters')))
+            files = [e.get('Include') for e in root.iter() if e.get('Include') is not None]
+            assert 'a\tb' in files, files
+        assert 'x\\two\nlines.cpp' in files, files
+    print('Checked the escaping of XML attributes')
+
+def test_configuration_matrix():
+    """Checks the lookup of project_info entries by configuration, with
+    wildcard keys, merging and configurations not resolved up front"""
+    project_info = {
+        'project_type' : 'Makefile',
+        'make|*' : {'a' : 'all', 'b' : 'all'},
+        'make|*|x64' : {'b' : 'x64'},
+        'make|Release|*' : {'a' : 'release'},
+        'make|Release|x64' : {'c' : 'release x64'},
+        'user|Debug' : {'u' : 'debug'},
+        'user|Win32' : {'u' : 'win32'},
+    }
+    expected = {
+        ('Debug', 'Win32') : ({'a' : 'all', 'b' : 'all'}, {'a' : 'all', 'b' : 'all'}),
+        ('Debug', 'x64') : ({'b' : 'x64'}, {'a' : 'all', 'b' : 'x64'}),
+        ('Release', 'Win32') : ({'a' : 'release'}, {'a' : 'release', 'b' : 'all'}),
+        ('Release', 'x64') : ({'c' : 'release x64'}, {'a' : 'release', 'b' : 'x64', 'c' : 'release x64'}),
+        # Not among the variants, so resolved on first use
+        ('Profile', 'x64') : ({'b' : 'x64'}, {'a' : 'all', 'b' : 'x64'}),
+    }
+    for merge in [False, True]:
+        matrix = ConfigurationMatrix(project_info, ['Debug', 'Release'], ['Win32', 'x64'], merge)
+        assert matrix.entries == ['make', 'user'], matrix.entries
+        for (variant, arch), values in sorted(expected.items()):
+            assert matrix.get('make', variant, arch) == values[merge], (merge, variant, arch)
+        assert ('make', 'Profile', 'x64') in matrix.matrix
+        # The variant is more specific than the arch
+        assert matrix.get('user', 'Debug', 'Win32') == {'u' : 'debug'}
+        assert matrix.get('user', 'Release', 'Win32') == {'u' : 'win32'}
+        assert matrix.get('user', 'Release', 'x64') == {}
+        assert matrix.get('missing', 'Debug', 'Win32') == {}
+    assert project_info['make|*'] == {'a' : 'all', 'b' : 'all'}, 'merging changed project_info'
+    print('Checked ConfigurationMatrix')
+
+def test_guid_registry():
+    """Checks that project GUIDs can be pinned by project name, and that
+    pinned and generated GUIDs survive saving and reloading the store"""
+    global guid_registry
+    import shutil
+    import tempfile
+    testroot = tempfile.mkdtemp(prefix = 'msvc_test')
+    previous = guid_registry
+    try:
+        store = os.path.join(testroot, 'guids.json')
+        def make(filepath):
+            return Project(filepath = filepath, variants = ['Debug'], archs = ['Win32'], files = {},
+                           version = 15.0, project_info = {'project_type' : 'Makefile'})
+        guid_registry = GuidRegistry(store)
+        hashed = make('a/foo.vcxproj').guid
+        assert hashed == _hashGUID('a/foo.vcxproj', None)
+        guid_registry.pin('a/foo.vcxproj', 'foo', '{PINNED}')
+        assert make('a/foo.vcxproj').guid == '{PINNED}'
+        other = make('b/bar.vcxproj').guid
+        guid_registry.save()
+
+        guid_registry = GuidRegistry(store)
+        assert make('a/foo.vcxproj').guid == '{PINNED}'
+        assert make('b/bar.vcxproj').guid == other
+    finally:
+        guid_registry = previous
+        shutil.rmtree(testroot, ignore_errors = True)
+    print('Checked GuidRegistry')
+
+def test_reduce_dependencies():
+    """Checks that solutions list only the reduced dependencies when asked
+    to, and that a dependency cycle is refused before writing anything"""
+    import io
+    import shutil
+    import tempfile
+    try:
+        from . import depgraph
+    except ImportError:
+        import depgraph
+    projects, dependencies = _get_test_projects(['Debug'], ['Win32'], 15.0, None)
+    third = Project(filepath = 'third.vcxproj', variants = ['Debug'], archs = ['Win32'], files = {},
+                    version = 15.0, project_info = projects[0].project_info)
+    projects.append(third)
+    dependencies[third] = [projects[0], projects[1]]
+    for reduce, count in [(False, 3), (True, 2)]:
+        out = io.StringIO()
+        write_solution(15.0, projects, ['Debug'], ['Win32'], dependencies, out, reduce_dependencies = reduce)
+        text = out.getvalue()
+        assert len([line for line in text.splitlines() if line.startswith('{')]) == count, text
+        assert text.count('\tEndProjectSection\nEndProject\n') == 2, text
+
+    dependencies[projects[0]] = [third]
+    testroot = tempfile.mkdtemp(prefix = 'msvc_test')
+    try:
+        solution = os.path.join(testroot, 'test.sln')
+        try:
+            write_all(solution, projects, dependencies, jobs = 1, reduce_dependencies = True)
+        except depgraph.DependencyCycleError:
+            pass
+        else:
+            assert False, 'No DependencyCycleError'
+        assert not os.path.exists(solution)
+    finally:
+        shutil.rmtree(testroot, ignore_errors = True)
+    print('Checked reduce_dependencies')
+
+def test_project_cache():
+    """Checks that a ProjectCache misses after any change to a project, that
+    its hits write the same bytes as an uncached write, and that evict()
+    bounds its size"""
+    import copy
+    import shutil
+    import tempfile
+    testroot = tempfile.mkdtemp(prefix = 'msvc_test')
+    try:
+        cache = ProjectCache(os.path.join(testroot, 'cache'))
+        project = _get_test_projects(['Debug', 'Release'], ['Win32', 'x64'], 15.0, None)[0][0]
+        def write(project, name, cache):
+            tracer = Tracer()
+            filepath = os.path.join(testroot, name, 'test.vcxproj')
+            _prepare_dirs(filepath)
+            write_project(project, filepath, tracer = tracer, cache = cache)
+            data = []
+            for kind in get_project_kinds(project):
+                with open(filepath + project_file_suffixes[kind], 'rb') as f:
+                    data.append(f.read())
+            return data, tracer.counters.get('cache_hits', 0)
+
+        expected, hits = write(project, 'uncached', None)
+        assert write(project, 'cold', cache) == (expected, 0)
+        assert write(project, 'warm', cache) == (expected, 1)
+
+        changed = [project.for_version(12.0), project.for_version(15.0, 14.2)]
+        changed.append(project.for_version(15.0))
+        changed[-1].files = dict(project.files, src = ['testfolder/main.cpp', 'testfolder/other.cpp'])
+        changed.append(project.for_version(15.0))
+        changed[-1].project_info = copy.deepcopy(project.project_info)
+        changed[-1].project_info['make_properties|x64']['output'] = 'bar.exe'
+        for i, p in enumerate(changed):
+            data, hits = write(p, 'changed%d' % i, cache)
+            assert hits == 0 and data == write(p, 'uncached%d' % i, None)[0], p.filepath
+        assert cache.get_key(project, 'utf-16') != cache.get_key(project)
+
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(cache.directory):
+            total += sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+        cache.max_bytes = total // 2
+        assert cache.evict() > 0
+        remaining = 0
+        for dirpath, dirnames, filenames in os.walk(cache.directory):
+            remaining += sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+        assert 0 < remaining <= cache.max_bytes, (remaining, cache.max_bytes)
+    finally:
+        shutil.rmtree(testroot, ignore_errors = True)
+    print('Checked ProjectCache')
+
+def test_tracer():
+    """Checks that write_all without a pool traces the projects it writes
+    in the calling process, with and without a cache or manifest"""
+    import shutil
+    import tempfile
+    testroot = tempfile.mkdtemp(prefix = 'msvc_test')
+    try:
+        projects, dependencies = _get_test_projects(['Debug', 'Release'], ['Win32', 'x64'], 15.0, None)
+        expected = Tracer()
+        for project in projects:
+            _count_project(project, expected)
+        cache = ProjectCache(os.path.join(testroot, 'cache'))
+        for name, args in [('plain', {}), ('cold', {'cache' : cache}), ('warm', {'cache' : cache}),
+                           ('manifest', {'manifest' : OutputManifest(None)})]:
+            tracer = Tracer()
+            solution = os.path.join(testroot, 'cold' if name == 'warm' else name, 'test.sln')
+            results = write_all(solution, projects, dependencies, jobs = 1, tracer = tracer, **args)
+            counters = tracer.counters
+            assert counters['projects'] == len(projects), (name, counters)
+            hits = len(projects) if name == 'warm' else 0
+            assert counters.get('cache_hits', 0) == hits, (name, counters)
+            if name != 'warm':
+                for counter in ['files', 'filters', 'configurations']:
+                    assert counters[counter] == expected.counters[counter], (name, counter, counters)
+                size = sum(os.path.getsize(path) for path, error in results)
+                assert counters['bytes_written'] == size, (name, counters['bytes_written'], size)
+            span_names = set(span[0] for span in tracer.spans)
+            assert set(['write_project', 'write_file']) <= span_names, (name, span_names)
+    finally:
+        shutil.rmtree(testroot, ignore_errors = True)
+    print('Checked tracing of write_all')
+
+def test_output_manifest():
+    """Checks that an OutputManifest removes the files no longer generated,
+    but not those of a project that failed to generate"""
+    import copy
+    import shutil
+    import tempfile
+    testroot = tempfile.mkdtemp(prefix = 'msvc_test')
+    try:
+        solution = os.path.join(testroot, 'test.sln')
+        projects, dependencies = _get_test_projects(['Debug'], ['Win32'], 15.0, None)
+        with OutputManifest(os.path.join(testroot, 'manifest.json')) as manifest:
+            results = write_all(solution, projects, dependencies, jobs = 1, manifest = manifest)
+        assert [error for path, error in results] == [None] * len(results)
+
+        project_info = copy.deepcopy(projects[0].project_info)
+        del project_info['make_properties|Win32']['output']
+        projects[0].project_info = project_info
+        projects[0].invalidate()
+        with OutputManifest(os.path.join(testroot, 'manifest.json')) as manifest:
+            results = write_all(solution, projects, dependencies, jobs = 1, manifest = manifest)
+        assert [path for path, error in results if error is not None] == [os.path.join(testroot, 'test.vcxproj')]
+        assert manifest.removed == [], manifest.removed
+        with OutputManifest(os.path.join(testroot, 'manifest.json')) as manifest:
+            write_all(solution, projects[1:], jobs = 1, manifest = manifest)
+        assert os.path.join(testroot, 'test.vcxproj') in manifest.removed, manifest.removed
+        assert not os.path.exists(os.path.join(testroot, 'test.vcxproj.filters'))
+    finally:
+        shutil.rmtree(testroot, ignore_errors = True)
+    print('Checked OutputManifest')
+
+def test_file_writer():
+    """Checks that a FileWriter reports the files it fails to write without
+    blocking, and leaves no temporary files behind"""
+    import shutil
+    import tempfile
+    testroot = tempfile.mkdtemp(prefix = 'msvc_test')
+    try:
+        paths = [os.path.join(testroot, name) for name in ['a', 'b', 'c', 'd', 'e', 'f']]
+        os.mkdir(paths[1])
+        writer = FileWriter(threads = 1, queue_size = 2, batch = 1, manifest = OutputManifest(None))
+        with writer:
+            writer.write(paths[0], 'not bytes')
+            writer.write(paths[1], b'a directory')
+            for path in paths[2:]:
+                writer.write(path, b'data')
+        results = writer.close()
+        assert [path for path, error in results] == paths
+        assert [error is None for path, error in results] == [False, False, True, True, True, True], results
+        assert sorted(os.listdir(testroot)) == ['b', 'c', 'd', 'e', 'f']
+    finally:
+        shutil.rmtree(testroot, ignore_errors = True)
+    print('Checked FileWriter')
+
 def test():
+    try:
+        from . import depgraph
+        from . import importer
+    except ImportError:
+        import depgraph
+        import importer
+    test_vc10_backends()
+    test_xml_escaping()
+    test_configuration_matrix()
+    test_guid_registry()
+    test_output_manifest()
+    test_file_writer()
+    test_project_cache()
+    test_tracer()
+    test_reduce_dependencies()
+    depgraph.test()
+    importer.test()
+
     variants = ['Debug', 'Release']
     archs = ['Win32', 'x64']
     version = 15.0
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Builds the file maps used by msvc.Project by scanning source trees"""
+
+#
+# Copyright (c) 2011 Thomas Berg
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import fnmatch
+import os
+import re
+import time
+
+# A typical mapping from file extension to filter, for the filters argument
+default_filters = {
+    '.c'   : 'Source Files',
+    '.cc'  : 'Source Files',
+    '.cpp' : 'Source Files',
+    '.cxx' : 'Source Files',
+    '.h'   : 'Header Files',
+    '.hh'  : 'Header Files',
+    '.hpp' : 'Header Files',
+    '.hxx' : 'Header Files',
+    '.inl' : 'Header Files',
+    '.rc'  : 'Resource Files',
+}
+
+class ScanCache(object):
+    """The directory listings of previous scans, stored in a JSON file and
+    keyed by the absolute path of the directory, so one cache can serve
+    several roots. A directory whose modification time has not changed is
+    not listed again, so a rescan only reads the directories in which
+    files were added, removed or renamed.
+
+    A change made within the same timestamp tick as a listing does not
+    change the modification time, so directories modified less than
+    racy_seconds before they are listed are not cached. The default suits
+    file systems with timestamps as coarse as two seconds, such as FAT."""
+
+    racy_seconds = 2.0
+
+    def __init__(self, filepath = None):
+        self.filepath = filepath
+        self.dirs = {}
+        self.visited = set()
+        if filepath is not None and os.path.exists(filepath):
+            import json
+            with open(filepath) as f:
+                self.dirs = json.load(f).get('dirs', {})
+
+    def save(self, filepath = None):
+        """Writes the listings of the directories visited since the cache
+        was loaded, dropping those of directories no longer scanned"""
+        import json
+        if filepath is None:
+            filepath = self.filepath
+        dirs = dict((key, self.dirs[key]) for key in self.visited if key in self.dirs)
+        with open(filepath, 'w') as out:
+            json.dump({'dirs' : dirs}, out, sort_keys = True)
+
+def _compile_patterns(patterns):
+    if not patterns:
+        return None
+    flags = re.IGNORECASE if os.name == 'nt' else 0
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(p) for p in patterns), flags)
+
+def _matches(pattern, relpath, name):
+    return pattern.match(relpath) is not None or pattern.match(name) is not None
+
+def _list_dir(root, reldir, cache):
+    """Returns the sorted file and directory names in a directory"""
+    path = os.path.join(root, reldir) if reldir else root
+    st = os.stat(path)
+    mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+    if cache is not None:
+        key = os.path.abspath(path)
+        cache.visited.add(key)
+        entry = cache.dirs.get(key)
+        if entry is not None and entry[0] == mtime:
+            return entry[1], entry[2]
+        listed_at = time.time()
+
+    files = []
+    dirs = []
+    for entry in os.scandir(path):
+        # Symbolic links to directories are skipped, to avoid cycles
+        if entry.is_dir(follow_symlinks = False):
+            dirs.append(entry.name)
+        elif not entry.is_dir():
+            files.append(entry.name)
+    files.sort()
+    dirs.sort()
+    if cache is not None:
+        if listed_at - st.st_mtime >= cache.racy_seconds:
+            cache.dirs[key] = [mtime, files, dirs]
+        else:
+            cache.dirs.pop(key, None)
+    return files, dirs
+
+def iter_scan(root, include = None, exclude = None, filters = None, default_filter = '',
+              prefix = '', jobs = 8, cache = None):
+    """Yields (filter, path) for each file below root, directory by
+    directory in breadth-first order, sorted by name within a directory.
+
+    include and exclude are lists of glob patterns, matched against both
+    the path relative to root (with / separators) and the file name. Only
+    files matching an include pattern are yielded (all if include is
+    None), and excluded directories are not descended into. Symbolic
+    links to directories are skipped.
+
+    filters maps lower case file extensions to filters. Files with other
+    extensions get default_filter, or are left out if it is None.
+
+    The yielded paths are relative to root, with prefix prepended, so they
+    can be used as they are in the files argument of msvc.Project.
+
+    Up to jobs directories are listed in parallel threads, which pays off
+    mostly on network file systems. An optional ScanCache avoids listing
+    unchanged directories again."""
+    include = _compile_patterns(include)
+    exclude = _compile_patterns(exclude)
+    if filters is None:
+        filters = {}
+
+    pool = None
+    if jobs > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(jobs)
+    try:
+        level = ['']
+        while level:
+            if pool is not None and len(level) > 1:
+                listings = pool.map(lambda reldir: _list_dir(root, reldir, cache), level)
+            else:
+                listings = [_list_dir(root, reldir, cache) for reldir in level]
+            next_level = []
+            for reldir, (files, dirs) in zip(level, listings):
+                base = reldir + '/' if reldir else ''
+                for name in files:
+                    relpath = base + name
+                    if exclude is not None and _matches(exclude, relpath, name):
+                        continue
+                    if include is not None and not _matches(include, relpath, name):
+                        continue
+                    filter = filters.get(os.path.splitext(name)[1].lower(), default_filter)
+                    if filter is None:
+                        continue
+                    yield filter, prefix + relpath
+                for name in dirs:
+                    relpath = base + name
+                    if exclude is None or not _matches(exclude, relpath, name):
+                        next_level.append(relpath)
+            level = next_level
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def scan(root, include = None, exclude = None, filters = None, default_filter = '',
+         prefix = '', jobs = 8, cache = None):
+    """Returns the files below root as a file map for msvc.Project, that is
+    a dict from filter to a list of paths. See iter_scan for the
+    arguments."""
+    files = {}
+    for filter, path in iter_scan(root, include, exclude, filters, default_filter, prefix, jobs, cache):
+        try:
+            files[filter].append(path)
+        except KeyError:
+            files[filter] = [path]
+    return files
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A long-running generator process serving requests on a Unix domain
+socket, so builds invoking the generators many times pay for starting
+Python, importing msvc and computing the project models only once"""
+
+#
+# Copyright (c) 2011 Thomas Berg
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import json
+import os
+import socket
+
+try:
+    from . import msvc
+except ImportError:
+    import msvc
+
+# The argument of each command holding a path, which a server would resolve
+# against its own working directory rather than that of the client
+path_arguments = {'write_project' : 'root', 'write_all' : 'solution'}
+
+class RequestError(RuntimeError):
+    """Raised by generate for a request the generator rejected or failed on"""
+
+def _get_path_argument(request):
+    if not isinstance(request, dict):
+        return None, None
+    key = path_arguments.get(request.get('command'))
+    if key is None:
+        return None, None
+    # write_project defaults to the current directory
+    return key, request.get(key, os.curdir if key == 'root' else None)
+
+def make_absolute(request):
+    """Returns a copy of request with its path argument made absolute,
+    resolved against the current directory"""
+    key, path = _get_path_argument(request)
+    if path is None:
+        return request
+    request = dict(request)
+    request[key] = os.path.abspath(path)
+    return request
+
+def describe_project(project):
+    """Returns the JSON description of an msvc.Project used in requests,
+    that is the arguments to construct it again"""
+    return {
+        'filepath' : project.filepath,
+        'archs' : list(project.archs),
+        'variants' : list(project.variants),
+        'files' : dict((key, list(paths)) for key, paths in project.files.items()),
+        'project_info' : project.project_info,
+        'name' : project.name,
+        'src_root' : project.src_root,
+        'strip_path' : project.strip_path,
+        'version' : project.version,
+        'toolset_version' : project.toolset_version,
+        'guid' : project.guid,
+        'merge_project_info' : project.merge_project_info,
+        'collapse_properties' : project.collapse_properties,
+    }
+
+class Generator(object):
+    """Handles generator requests, keeping the projects it was sent between
+    requests so their file models and configurations are only computed
+    again when their description changes. Files are written through an
+    in-memory OutputManifest, so unchanged files are not touched.
+
+    A request is a dict with a 'command' and its arguments:
+
+    - ping: returns the process id and the number of projects held
+    - write_project: writes 'project' (see describe_project), with its
+      path taken relative to the directory 'root'
+    - write_all: writes the solution file 'solution' and its 'projects',
+      see msvc.write_all. 'dependencies' and 'folders' refer to projects
+      by their filepath. Projects are written in this process unless
+      'jobs' is given.
+    - reset: forgets the projects held
+
+    handle returns {'result' : ...} or {'error' : message}, plus the files
+    'written' and 'skipped' by the request."""
+
+    def __init__(self, cache = None, tracer = None):
+        self.cache = cache
+        self.tracer = tracer
+        self.manifest = msvc.OutputManifest(None)
+        self.projects = {}
+
+    def get_project(self, root, description):
+        key = (os.path.abspath(root), description['filepath'])
+        data = json.dumps(description, sort_keys = True)
+        known = self.projects.get(key)
+        if known is not None and known[0] == data:
+            return known[1]
+        project = msvc.Project(**description)
+        self.projects[key] = (data, project)
+        return project
+
+    def _write_project(self, request):
+        root = request.get('root', os.curdir)
+        project = self.get_project(root, request['project'])
+        filepath = os.path.join(root, project.filepath)
+        msvc._prepare_dirs(filepath)
+        msvc.write_project(project, filepath, manifest = self.manifest, tracer = self.tracer, cache = self.cache)
+        return project.guid
+
+    def _write_all(self, request):
+        solution = request['solution']
+        root = os.path.split(solution)[0]
+        projects = [self.get_project(root, description) for description in request['projects']]
+        by_path = dict((p.filepath, p) for p in projects)
+        dependencies = {}
+        for filepath, deps in (request.get('dependencies') or {}).items():
+            dependencies[by_path[filepath]] = [by_path[d] for d in deps]
+        folders = None
+        if request.get('folders'):
+            folders = dict((by_path[filepath], folder) for filepath, folder in request['folders'].items())
+        results = msvc.write_all(solution, projects, dependencies,
+                                 solution_items = request.get('solution_items'),
+                                 jobs = request.get('jobs', 1),
+                                 version = request.get('version'),
+                                 variants = request.get('variants'),
+                                 archs = request.get('archs'),
+                                 manifest = self.manifest,
+                                 tracer = self.tracer,
+                                 folders = folders,
+                                 cache = self.cache)
+        return [list(r[:2]) for r in results]
+
+    def handle(self, request):
+        try:
+            if not isinstance(request, dict):
+                raise ValueError('Invalid request: expected a JSON object, got %s' % type(request).__name__)
+            command = request.get('command')
+            if command == 'ping':
+                result = {'pid' : os.getpid(), 'projects' : len(self.projects)}
+            elif command == 'write_project':
+                result = self._write_project(request)
+            elif command == 'write_all':
+                result = self._write_all(request)
+            elif command == 'reset':
+                self.projects.clear()
+                result = None
+            else:
+                raise ValueError('Unknown command: %r' % (command,))
+            response = {'result' : result}
+        except Exception as e:
+            response = {'error' : msvc._format_error(e)}
+        # The in-memory manifest keeps its entries, but not the lists of
+        # files, which would grow with every request
+        response['written'] = self.manifest.written
+        response['skipped'] = self.manifest.skipped
+        self.manifest.written = []
+        self.manifest.skipped = []
+        return response
+
+def _is_listening(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+class Server(object):
+    """Serves a Generator on a Unix domain socket, one connection at a
+    time. Each request is a JSON object on a line of its own, answered by
+    the response on a line of its own; a connection may carry several.
+    The 'shutdown' command stops the server after answering.
+
+    As the server has a working directory of its own, requests with a
+    relative root or solution are rejected, see make_absolute."""
+
+    def __init__(self, socket_path, generator = None):
+        self.socket_path = socket_path
+        self.generator = generator
+        if generator is None:
+            self.generator = Generator()
+        self.stopped = False
+
+    def _serve_connection(self, conn):
+        stream = conn.makefile('rwb')
+        with stream:
+            for line in stream:
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError as e:
+                    response = {'error' : 'Invalid request: %s' % e}
+                else:
+                    key, path = _get_path_argument(request)
+                    if isinstance(request, dict) and request.get('command') == 'shutdown':
+                        self.stopped = True
+                        response = {'result' : None}
+                    elif path is not None and not os.path.isabs(path):
+                        response = {'error' : 'The %s of a request to a server must be an absolute path: %r' % (key, path)}
+                    else:
+                        response = self.generator.handle(request)
+                stream.write(json.dumps(response).encode('utf-8') + b'\n')
+                stream.flush()
+                if self.stopped:
+                    break
+
+    def serve(self):
+        """Serves requests until the shutdown command, or until interrupted
+        with Ctrl-C. A socket file left by a server that is gone is
+        replaced, but not that of a running server."""
+        if os.path.exists(self.socket_path):
+            if _is_listening(self.socket_path):
+                raise RuntimeError('A server is already running on %s' % self.socket_path)
+            os.remove(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.socket_path)
+            sock.listen(16)
+            while not self.stopped:
+                conn, _ = sock.accept()
+                with conn:
+                    try:
+                        self._serve_connection(conn)
+                    except OSError:
+                        # The client went away
+                        pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            msvc._remove_quietly(self.socket_path)
+
+def send(socket_path, request, timeout = None):
+    """Sends a request to the server at socket_path and returns its
+    response. Raises OSError if no server is running there."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        stream = sock.makefile('rwb')
+        with stream:
+            stream.write(json.dumps(request).encode('utf-8') + b'\n')
+            stream.flush()
+            line = stream.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise ConnectionError('The server at %s closed the connection' % socket_path)
+    return json.loads(line.decode('utf-8'))
+
+_local_generator = None
+
+def generate(request, socket_path = None, timeout = None):
+    """Has a request handled by the server at socket_path, or in this
+    process if no server is running there (or socket_path is None, or the
+    platform lacks Unix domain sockets). The in-process Generator is kept
+    for the following calls. Returns the result of the request, raising
+    RequestError if it failed.
+
+    The root or solution of the request is made absolute first, so both
+    ways write to the same place. Requests are idempotent, so a request
+    that may have reached a server that then failed is simply handled
+    again in this process."""
+    global _local_generator
+    request = make_absolute(request)
+    response = None
+    if socket_path is not None and hasattr(socket, 'AF_UNIX'):
+        try:
+            response = send(socket_path, request, timeout)
+        except OSError:
+            pass
+    if response is None:
+        if _local_generator is None:
+            _local_generator = Generator()
+        response = _local_generator.handle(request)
+    if 'error' in response:
+        raise RequestError(response['error'])
+    return response['result']
+
+def main(argv = None):
+    import argparse
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('socket', help = 'path of the Unix domain socket to listen on')
+    parser.add_argument('--cache', help = 'directory of a ProjectCache to use')
+    parser.add_argument('--cache-size', type = int, default = 256, help = 'size of the cache in MB')
+    args = parser.parse_args(argv)
+    cache = None
+    if args.cache is not None:
+        cache = msvc.ProjectCache(args.cache, args.cache_size * 1024 * 1024)
+    Server(args.socket, Generator(cache)).serve()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Keeps projects up to date while files are added to and removed from
+their source trees, rewriting only the projects whose file set changed"""
+
+#
+# Copyright (c) 2011 Thomas Berg
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import os
+import time
+
+try:
+    from . import msvc
+    from . import scanner
+except ImportError:
+    import msvc
+    import scanner
+
+def _normalize(files):
+    """Returns a file map in the form msvc.Project stores it, for comparing"""
+    return dict((key, tuple(paths)) for key, paths in files.items() if paths)
+
+class _Watched(object):
+    __slots__ = ['project', 'root', 'scan_args', 'cache', 'pending', 'changed_at']
+
+    def __init__(self, project, root, scan_args):
+        self.project = project
+        self.root = root
+        self.scan_args = scan_args
+        self.cache = scanner.ScanCache()
+        self.pending = None
+        self.changed_at = None
+
+class Watcher(object):
+    """Polls the source roots of a set of projects and rewrites the files
+    of a project when its file set changes.
+
+    The projects are kept in memory together with the directory listings
+    of their source roots, so a poll only stats the directories and lists
+    again those whose modification time changed. A change is written once
+    the file set has been stable for debounce seconds, so saving a batch of
+    files or checking out a branch results in a single rewrite. The project
+    files are written with an OutputManifest, which skips the files whose
+    content did not change, such as the .user file.
+
+    solution_dir is the directory the paths of the projects are relative
+    to, as for msvc.write_all. callback, if given, is called with the list
+    of projects written after each poll that wrote any. Scan and write
+    errors are appended to errors as (path, message) tuples; a project
+    that failed to be written is tried again on the next poll."""
+
+    def __init__(self, solution_dir, interval = 0.5, debounce = 0.2, manifest = None, callback = None, tracer = None):
+        self.solution_dir = solution_dir
+        self.interval = interval
+        self.debounce = debounce
+        self.manifest = manifest
+        if manifest is None:
+            self.manifest = msvc.OutputManifest(None)
+        self.callback = callback
+        self.tracer = tracer
+        self.watched = []
+        self.errors = []
+
+    def add(self, project, root, **scan_args):
+        """Watches the files below root for project. The keyword arguments
+        are passed to scanner.scan, and must produce the file map of the
+        project; its current files are replaced on the first change."""
+        self.watched.append(_Watched(project, root, scan_args))
+
+    def _rescan(self, watched):
+        try:
+            files = scanner.scan(watched.root, cache = watched.cache, jobs = 1, **watched.scan_args)
+        except OSError as e:
+            # The root may be gone temporarily, e.g. during a checkout
+            self.errors.append((watched.root, msvc._format_error(e)))
+            return
+        files = _normalize(files)
+        if files == _normalize(watched.project.files):
+            watched.pending = None
+            watched.changed_at = None
+        elif files != watched.pending:
+            watched.pending = files
+            watched.changed_at = time.time()
+
+    def poll(self):
+        """Rescans all roots once and writes the projects whose changes
+        have settled. Returns the list of projects written."""
+        written = []
+        now = time.time()
+        for watched in self.watched:
+            self._rescan(watched)
+            if watched.pending is None or now - watched.changed_at < self.debounce:
+                continue
+            project = watched.project
+            previous = project.files
+            project.files = watched.pending
+            filepath = os.path.join(self.solution_dir, project.filepath)
+            try:
+                msvc.write_project(project, filepath, manifest = self.manifest, tracer = self.tracer)
+            except Exception as e:
+                # Keeps the change pending, so it is written again on the
+                # next poll, as soon as the cause is fixed
+                project.files = previous
+                self.errors.append((filepath, msvc._format_error(e)))
+                continue
+            watched.pending = None
+            watched.changed_at = None
+            written.append(project)
+        if written and self.callback is not None:
+            self.callback(written)
+        return written
+
+    def run(self, stop = None):
+        """Polls every interval seconds until stop() returns true, or until
+        interrupted with Ctrl-C"""
+        try:
+            while stop is None or not stop():
+                self.poll()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass